@@ -0,0 +1,345 @@
+#benchmarks of the looming pipeline on synthetic recordings
+#
+#   python looming_benchmark.py                      #scales 1, 10 and 100
+#   python looming_benchmark.py --scales 1 10 --compare
+#
+#scale 1 is one fly of 9 trials (one block of the 9 looming conditions) for
+#the fly stages, and 2 flies of 9 trials for the population builders. scale
+#n has n times the trials per fly, and n times the flies. the population 
+#store is decimated to 1 khz (--pop-rate), as full rate summary cubes of 
+#hundreds of flies do not fit in memory.
+#each suite appends one row per benchmark to benchmarks/results.csv as it 
+#finishes, tagged with the run and commit, and the full stage profile of the
+#run (see start_profiling) goes to benchmarks/profiles/
+
+import matplotlib
+matplotlib.use('agg')
+import numpy as np
+import pandas as pd
+import sys, os
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import looming_flight_phys as lfp
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'benchmarks')
+
+#---------------------------------------------------------------------------#
+# synthetic recordings -- channel dicts like read_abf's. the 9 looming
+# conditions (3 positions x 3 l/v, in looming_labels order) are shuffled in
+# blocks. the fly stops flying now and then, makes spontaneous saccades and
+# turns away from most looms, the wing tracker glitches, and vm depolarizes
+# to looms, most to those on the right
+
+loom_positions = [2.,5.,8.] #x_ch of left, center and right looms
+loom_l_over_vs = [.022,.044,.088] #s
+loom_vm_gains = [1.,3.,6.] #mV of depolarization at 180 degrees, by position
+wing_gain = 33.75 #degrees per volt, see process_wings
+
+#the protocol of the synthetic flies -- the looming labels, with the patid 
+#levels of synthetic_recording as its ao codes. it is only known to 
+#looming_flight_phys once register_synthetic_protocol has run
+synthetic_protocol = 'looming-synthetic'
+
+def register_synthetic_protocol():
+    lfp.stim_label_tables[synthetic_protocol] = lfp.looming_labels
+    lfp.stim_ao_code_tables[synthetic_protocol] = [5.5 + .5*condition for condition in range(9)]
+
+def synthetic_recording(n_trs=9, duration=None, fs=10000, seed=0, loom_dur=2., iti_dur=4.,
+                        nonflight_frac=.1, saccade_rate=.3, artifact_rate=.05, wingbeat_freq=200):
+    #channels of one synthetic fly in volts (float32), keyed like read_abf's.
+    #duration (s), if given, sets the number of trials instead of n_trs.
+    #nonflight_frac is the expected fraction of time not flying, and
+    #saccade_rate (spontaneous saccades) and artifact_rate are per second
+    rs = np.random.RandomState(seed)
+    tr_len = int(loom_dur*fs)
+    if duration is not None:
+        n_trs = max(int((duration - iti_dur)/(loom_dur + iti_dur)),0)
+
+    #trial schedule. itis are jittered by 10%
+    conditions = np.hstack([rs.permutation(9) for block in range(n_trs//9 + 1)])[:n_trs]
+    positions = conditions//3
+    l_over_vs = np.array(loom_l_over_vs)[conditions%3]
+    itis = (iti_dur*fs*rs.uniform(.9,1.1,n_trs + 1)).astype(int)
+    tr_starts = np.cumsum(itis[:-1]) + np.arange(n_trs)*tr_len
+    n_samples = int(np.sum(itis) + n_trs*tr_len)
+
+    #non-flight bouts of 2-8 s
+    is_flying = np.ones(n_samples,dtype=bool)
+    bout_len = 5*fs
+    n_bouts = rs.poisson(nonflight_frac*n_samples/float(bout_len))
+    for start in rs.randint(0,n_samples,n_bouts):
+        is_flying[start:start + int(rs.uniform(.4,1.6)*bout_len)] = False
+    is_stopped = ~is_flying
+
+    #looms expand to collision .5 s before the trial ends, then fill the screen.
+    #ystim is the loom's angular size, patid codes the condition
+    t_collision = loom_dur - .5
+    t = np.arange(tr_len)/float(fs)
+    loom_angles = dict([(l_over_v,loom_angle(t,l_over_v,t_collision)) for l_over_v in loom_l_over_vs])
+    x_ch = np.zeros(n_samples,dtype=np.float32)
+    y_ch = np.zeros(n_samples,dtype=np.float32)
+    patid = white_noise(rs,n_samples,.01)
+    vm = -50 + slow_noise(rs,n_samples,fs,.5,1.) + white_noise(rs,n_samples,.3)
+    vm[is_stopped] -= 2
+    for tr in range(n_trs):
+        trial = slice(tr_starts[tr],tr_starts[tr] + tr_len)
+        angle = loom_angles[l_over_vs[tr]]
+        x_ch[trial] = loom_positions[positions[tr]]
+        y_ch[trial] = angle/18.
+        patid[trial] += 5.5 + .5*conditions[tr]
+        vm[trial] += loom_vm_gains[positions[tr]]*angle/180.
+
+    #saccades are .2 s bumps in l-r. spontaneous ones at random, evoked ones
+    #in 80% of trials, 70 ms after the loom passes 60 degrees -- away from side
+    #looms, to a random side for center looms
+    spont_times = rs.randint(0,n_samples,rs.poisson(saccade_rate*n_samples/float(fs)))
+    spont_signs = rs.choice([-1,1],len(spont_times))
+    is_evoked = rs.rand(n_trs) < .8
+    evoked_times = tr_starts + ((t_collision - l_over_vs/np.tan(np.radians(30)) + .07)*fs).astype(int)
+    evoked_signs = np.where(positions == 0,1,np.where(positions == 2,-1,rs.choice([-1,1],n_trs)))
+    saccade_times = np.hstack((spont_times,evoked_times[is_evoked])).astype(int)
+    saccade_mags = np.hstack((spont_signs,evoked_signs[is_evoked]))*rs.uniform(15,30,len(saccade_times))
+
+    saccade_shape = np.sin(np.linspace(0,np.pi,int(.2*fs)))**2
+    turns = np.zeros(n_samples,dtype=np.float32)
+    for saccade_time, mag in zip(saccade_times,saccade_mags):
+        if is_flying[saccade_time]:
+            turn = turns[saccade_time:saccade_time + len(saccade_shape)]
+            turn += mag*saccade_shape[:len(turn)]
+
+    #wings beat at ~60 degrees, with slow drift and tracker noise, and are lost
+    #by the tracker when the fly stops
+    wing_v = (60 + 45)/wing_gain
+    wba_l = wing_v + slow_noise(rs,n_samples,fs,5,.05) + white_noise(rs,n_samples,.02) + turns/(2*wing_gain)
+    wba_r = wing_v + slow_noise(rs,n_samples,fs,5,.05) + white_noise(rs,n_samples,.02) - turns/(2*wing_gain)
+    del turns
+    wba_l[is_stopped] = white_noise(rs,np.sum(is_stopped),.02)
+    wba_r[is_stopped] = white_noise(rs,np.sum(is_stopped),.02)
+
+    #tracker glitches -- a few samples of one wing at 0 or 10 volts
+    n_artifacts = rs.poisson(artifact_rate*n_samples/float(fs))
+    for start, wing, value in zip(rs.randint(0,n_samples,n_artifacts),rs.randint(0,2,n_artifacts),
+                                  rs.choice([0.,10.],n_artifacts)):
+        [wba_l,wba_r][wing][start:start + rs.randint(1,5)] = value
+
+    period = int(round(fs/float(wingbeat_freq)))
+    tach = np.tile(np.sin(2*np.pi*np.arange(period)/period).astype(np.float32),n_samples//period + 1)[:n_samples]
+    tach[is_stopped] = 0
+    tach += white_noise(rs,n_samples,.05)
+
+    return {'x_ch':x_ch,'y_ch':y_ch,'wba_l':wba_l,'wba_r':wba_r,'patid':patid,'vm':vm,'tach':tach}
+
+def loom_angle(t, l_over_v, t_collision):
+    #angular size (degrees) of an object of half size l approaching at speed v
+    with np.errstate(divide='ignore'):
+        return 2*np.degrees(np.arctan(l_over_v/np.maximum(t_collision - t,0)))
+
+def white_noise(rs, n_samples, scale, chunk_size=2**22):
+    noise = np.empty(n_samples,dtype=np.float32)
+    for start, stop in lfp.chunk_bounds(n_samples,chunk_size):
+        noise[start:stop] = rs.randn(stop - start)*scale
+    return noise
+
+def slow_noise(rs, n_samples, fs, cutoff, scale, chunk_size=2**22):
+    #noise with little power above cutoff hz -- gaussian knots at 2*cutoff,
+    #linearly interpolated
+    step = fs/(2.*cutoff)
+    knots = rs.randn(int(n_samples/step) + 2)*scale
+    noise = np.empty(n_samples,dtype=np.float32)
+    for start, stop in lfp.chunk_bounds(n_samples,chunk_size):
+        noise[start:stop] = np.interp(np.arange(start,stop)/step,np.arange(len(knots)),knots)
+    return noise
+
+#recordings already generated, by file name. read_synthetic_abf hands each
+#one out once instead of generating it again
+synthetic_recordings = {}
+
+def write_synthetic_abf(abf_filename, **recording_kwargs):
+    #a stand-in .abf file holding the synthetic_recording arguments of a fly
+    with open(abf_filename,'w') as f:
+        json.dump(recording_kwargs,f,sort_keys=True)
+
+def read_synthetic_abf(abf_filename):
+    #drop-in for read_abf, for stand-in .abf files (see write_synthetic_abf)
+    if abf_filename in synthetic_recordings:
+        return synthetic_recordings.pop(abf_filename)
+    with open(abf_filename) as f:
+        recording_kwargs = json.load(f)
+    return synthetic_recording(**dict([(str(k),v) for k, v in recording_kwargs.items()]))
+
+def synthetic_population(data_dir, n_flies, genotypes=['gA','gB'], seed=0, **recording_kwargs):
+    #stand-in .abf files for n_flies flies, alternating genotypes, and their
+    #catalog. pop_fly_tasks drops the first sorted genotype (the catalog's
+    #label row), so the catalog starts with an empty one
+    catalog_rows = [['','','']]
+    for fly_i in range(n_flies):
+        fly_name = 'fly_%03d' % fly_i
+        write_synthetic_abf(os.path.join(data_dir,fly_name + '.abf'),seed=seed + fly_i,**recording_kwargs)
+        catalog_rows.append([fly_name,genotypes[fly_i % len(genotypes)],synthetic_protocol])
+    return pd.DataFrame(catalog_rows,columns=['file_name','genotype','type'])
+
+#---------------------------------------------------------------------------#
+
+def timed(benchmark, func, *args, **kwargs):
+    #run func as one profiled stage, named after the benchmark
+    with lfp.profile_stage(benchmark):
+        return func(*args, **kwargs)
+
+def fly_benchmarks(data_dir, scale, n_trs=9):
+    #the stages of one fly, one at a time. the stages run without the stage
+    #cache, except for the two process_fly benchmarks
+    fname = os.path.join(data_dir,'fly_x%d.abf' % scale)
+    recording_kwargs = {'n_trs':n_trs*scale,'seed':scale}
+    write_synthetic_abf(fname,**recording_kwargs)
+    synthetic_recordings[fname] = timed('synthesize',synthetic_recording,**recording_kwargs)
+
+    fly = lfp.Looming_Phys(fname,synthetic_protocol)
+    timed('open_abf (new abf cache)',fly.open_abf)
+    fly = lfp.Looming_Phys(fname,synthetic_protocol)
+    timed('open_abf',fly.open_abf)
+    timed('clean_lmr_signal',fly.clean_lmr_signal)
+    timed('parse_trial_times',fly.parse_trial_times)
+    timed('parse_stim_type',fly.parse_stim_type)
+    timed('get_traces_by_stim',fly.get_traces_by_stim,'fly_x%d' % scale)
+    timed('find_saccades',lfp.find_saccades,fly.lmr)
+    sizes = {'n_flies':1,'n_trs':n_trs*scale,'n_samples':fly.n_samples}
+
+    del fly
+    timed('process_fly (new stage cache)',lfp.Looming_Phys(fname,synthetic_protocol).process_fly)
+    timed('process_fly (stage cache)',lfp.Looming_Phys(fname,synthetic_protocol).process_fly)
+    return sizes
+
+def cache_synthetic_fly(fly_task):
+    #generate a fly of a synthetic population into its abf cache
+    return np.size(lfp.read_abf_cached(fly_task[0] + '.abf')['x_ch'])
+
+def all_genotype_histograms(population, n_workers=1):
+    return [lfp.pop_lmr_histograms(population,g,n_workers=n_workers) for g in lfp.pop_genotypes(population)]
+
+def population_benchmarks(data_dir, scale, n_trs=9, n_flies=2, n_workers=1, df_limit=2**30,
+                          rate=1000):
+    #the population builders on flies already in their abf caches, so they
+    #time the processing and not the generator. the store, and so the summary
+    #cube and histograms, are at rate. get_pop_traces_df is always at full rate,
+    #and is skipped when its data frame would take more than df_limit bytes
+    pop_dir = os.path.join(data_dir,'population_x%d' % scale)
+    os.makedirs(pop_dir)
+    path_name = os.path.join(pop_dir,'')
+    n_flies = n_flies*scale
+    catalog = synthetic_population(pop_dir,n_flies,seed=1000*scale,n_trs=n_trs)
+    fly_tasks, fly_genotypes = lfp.pop_fly_tasks(path_name,catalog)
+    n_samples = timed('synthesize population',lfp.map_flies,cache_synthetic_fly,fly_tasks,n_workers,'synthetic flies')
+
+    df_bytes = 8.*n_flies*n_trs*5*(25000 + 30000) #float64, 5 traces, window of get_trial_tensor
+    if df_bytes < df_limit:
+        timed('get_pop_traces_df',lfp.get_pop_traces_df,path_name,catalog,n_workers)
+    else:
+        print 'skipped get_pop_traces_df (' + str(int(df_bytes/2**20)) + ' MB)'
+    store = timed('build_pop_store',lfp.build_pop_store,path_name,catalog,os.path.join(pop_dir,'store'),
+                  n_workers,rate=rate)
+    timed('build_summary_cube',lfp.build_summary_cube,store)
+    timed('pop_lmr_histograms',all_genotype_histograms,store,n_workers)
+    return {'n_flies':n_flies,'n_trs':n_flies*n_trs,'n_samples':int(np.sum(n_samples))}
+
+def git_commit():
+    #short hash of the checked out commit, + if looming_flight_phys.py has changes
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull,'w') as devnull: #outside a checkout git only complains
+        try:
+            commit = subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=repo_dir,
+                                             stderr=devnull).strip()
+            changes = subprocess.check_output(['git','status','--porcelain','looming_flight_phys.py'],
+                                              cwd=repo_dir,stderr=devnull)
+            return commit + ('+' if changes.strip() else '')
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+result_columns = ['run','commit','python','numpy','scale','suite','benchmark','n_flies','n_trs',
+                  'n_samples','wall_time','cpu_time','peak_rss_delta','rss_delta']
+
+def append_csv(df, fname):
+    df.to_csv(fname,mode='a',index=False,header=not os.path.exists(fname))
+
+def run_benchmarks(scales=[1,10,100], n_trs=9, n_flies=2, n_workers=1, df_limit=2**30, pop_rate=1000,
+                   results_dir=results_dir, keep_data=False):
+    #run both suites at each scale. returns this run's rows of results.csv
+    lfp.read_abf = read_synthetic_abf
+    register_synthetic_protocol()
+    run = time.strftime('%Y%m%d_%H%M%S')
+    run_info = {'run':run,'commit':git_commit(),'python':platform.python_version(),'numpy':np.__version__}
+    data_dir = tempfile.mkdtemp(prefix='looming_benchmark_')
+    if results_dir is not None and not os.path.exists(os.path.join(results_dir,'profiles')):
+        os.makedirs(os.path.join(results_dir,'profiles'))
+
+    results = []
+    try:
+        for scale in scales:
+            for suite, suite_func, suite_kwargs in [('fly',fly_benchmarks,{'n_trs':n_trs}),
+                                                    ('population',population_benchmarks,
+                                                     {'n_trs':n_trs,'n_flies':n_flies,'n_workers':n_workers,
+                                                      'df_limit':df_limit,'rate':pop_rate})]:
+                lfp.start_profiling()
+                try:
+                    sizes = suite_func(data_dir,scale,**suite_kwargs)
+                finally:
+                    records = lfp.stop_profiling()
+                records['scale'] = scale
+                records['suite'] = suite
+
+                suite_results = records[~records['stage'].str.contains('/')].copy()
+                suite_results = suite_results.rename(columns={'stage':'benchmark'})
+                for name, value in run_info.items() + sizes.items():
+                    suite_results[name] = value
+                suite_results = suite_results[result_columns]
+                results.append(suite_results)
+                print suite_results[['scale','benchmark','n_trs','wall_time','cpu_time','peak_rss_delta']].to_string(index=False)
+
+                #saved suite by suite, so a run that runs out of memory keeps the smaller scales
+                if results_dir is not None:
+                    append_csv(suite_results,os.path.join(results_dir,'results.csv'))
+                    append_csv(records,os.path.join(results_dir,'profiles',run + '.csv'))
+    finally:
+        if not keep_data:
+            shutil.rmtree(data_dir,ignore_errors=True)
+    return pd.concat(results) if results else pd.DataFrame(columns=result_columns)
+
+def load_results(results_dir=results_dir):
+    return pd.read_csv(os.path.join(results_dir,'results.csv'),dtype={'run':str,'commit':str})
+
+def compare_runs(results, run=None, baseline=None):
+    #wall time of each benchmark in run against baseline -- by default the
+    #last run and the one before it
+    runs = sorted(results['run'].unique())
+    run = runs[-1] if run is None else run
+    baseline = runs[-2] if baseline is None else baseline
+    wall_times = results.pivot_table(index=['scale','benchmark'],columns='run',values='wall_time')
+    comparison = pd.DataFrame({'baseline':wall_times[baseline],'run':wall_times[run]},
+                              columns=['baseline','run'])
+    comparison['ratio'] = comparison['run']/comparison['baseline']
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the looming pipeline on synthetic recordings')
+    parser.add_argument('--scales',type=int,nargs='+',default=[1,10,100])
+    parser.add_argument('--n-trs',type=int,default=9,help='trials per fly at scale 1')
+    parser.add_argument('--n-flies',type=int,default=2,help='population flies at scale 1')
+    parser.add_argument('--workers',type=int,default=1)
+    parser.add_argument('--df-limit',type=float,default=1024,
+                        help='largest get_pop_traces_df data frame to build, MB')
+    parser.add_argument('--pop-rate',type=int,default=1000,help='sample rate of the population store')
+    parser.add_argument('--results-dir',default=results_dir)
+    parser.add_argument('--keep-data',action='store_true',help='keep the synthetic recordings')
+    parser.add_argument('--compare',action='store_true',help='compare with the previous run')
+    args = parser.parse_args()
+
+    run_benchmarks(args.scales,args.n_trs,args.n_flies,args.workers,args.df_limit*2**20,args.pop_rate,
+                   args.results_dir,args.keep_data)
+    if args.compare:
+        results = load_results(args.results_dir)
+        if results['run'].nunique() > 1:
+            print compare_runs(results).to_string()
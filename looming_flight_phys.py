@@ -1,4 +1,4 @@
-from neo.io import AxonIO
+from neo.rawio.axonrawio import AxonRawIO
 import numpy as np
 from scipy.io import loadmat
 import matplotlib.cm as cm
@@ -12,16 +12,185 @@ from scipy import signal
 from scipy.stats import circmean, circstd
 from plotting_help import *
 import sys, os
+import time
+import glob
+import traceback
+import multiprocessing
+import functools
 import scipy.signal
 from bisect import bisect
 import cPickle
+import hashlib
+import shutil
+import tempfile
+import warnings
 import math
 import pandas as pd
 import scipy as sp
+import scipy.special
+import scipy.stats
+try:
+    import resource
+except ImportError: #windows
+    resource = None
+
+figures_path = '/Users/jamie/bin/figures/' #where saved figures go, unless a plot gets an out_dir
+
+def figure_dir(out_dir=None):
+    #folder (with trailing separator) that a plot saves into
+    return os.path.join(figures_path if out_dir is None else out_dir,'')
+
+#---------------------------------------------------------------------------#
+# stage profiling -- off unless start_profiling is called. each stage of the 
+# pipeline (see profiled and profile_stage) then adds one record per call: 
+# wall and cpu time, growth of peak resident memory (rss) and net rss growth.
+# rss growth stands in for bytes allocated -- numpy allocations are not 
+# traced in python 2. stop_profiling returns the records as a data frame
+
+profile_records = None #list of stage records while profiling
+profile_stack = [] #the stages running now, outermost first
+profile_columns = ['fly','stage','pid','start','wall_time','cpu_time',
+                   'peak_rss_delta','rss_delta','failed']
+
+def start_profiling():
+    global profile_records
+    profile_records = []
+    del profile_stack[:]
+
+def stop_profiling(report_fname=None):
+    #records of the stages since start_profiling, saved as .json or .csv
+    global profile_records
+    records = pd.DataFrame(profile_records or [],columns=profile_columns)
+    profile_records = None
+    if report_fname is not None:
+        if report_fname.endswith('.json'):
+            records.to_json(report_fname,orient='records')
+        else:
+            records.to_csv(report_fname,index=False)
+    return records
+    
+def load_profile(report_fname):
+    if report_fname.endswith('.json'):
+        return pd.read_json(report_fname,orient='records')[profile_columns]
+    return pd.read_csv(report_fname)
+
+def profile_summary(records):
+    #per stage totals of one or more profiles (pd.concat reports of several 
+    #runs first), slowest stages first
+    records = records.fillna({'fly':''})
+    summary = records.groupby('stage').agg({'wall_time':['count','sum','mean','max'],
+                                            'cpu_time':['sum'],
+                                            'peak_rss_delta':['max'],
+                                            'rss_delta':['mean'],
+                                            'fly':['nunique']})
+    return summary.sort_values(('wall_time','sum'),ascending=False)
+    
+def rss_bytes():
+    #current and peak resident memory of this process. on linux both come from
+    #/proc, elsewhere the peak comes from getrusage and the current rss is nan
+    try:
+        with open('/proc/self/status') as f:
+            status = dict([line.split(':',1) for line in f if ':' in line])
+        return float(status['VmRSS'].split()[0])*1024, float(status['VmHWM'].split()[0])*1024
+    except (IOError, KeyError):
+        if resource is None:
+            return np.nan, np.nan
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return np.nan, float(peak if sys.platform == 'darwin' else peak*1024)
+        
+def reset_peak_rss():
+    #set the kernel's peak rss back to the current rss (linux 4.0+)
+    try:
+        with open('/proc/self/clear_refs','w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+class Profiled_Stage():
+    #times one stage. stages nest -- a record's stage is the path of the 
+    #enclosing stages, e.g. 'process_fly/clean_lmr_signal', and a stage with no
+    #fly gets the fly of the stage around it. the peak rss is reset at the 
+    #start of each stage, so each stage folds its peak into its parent's
+    def __init__(self, stage, fly=''):
+        self.stage = stage
+        self.fly = fly
+        
+    def __enter__(self):
+        rss, peak = rss_bytes()
+        if profile_stack:
+            parent = profile_stack[-1]
+            parent.peak = max(parent.peak,peak)
+            self.fly = self.fly or parent.fly
+        self.path = '/'.join([stage.stage for stage in profile_stack] + [self.stage])
+        profile_stack.append(self)
+        
+        reset_peak_rss()
+        self.start_rss, self.start_peak = rss_bytes()
+        self.peak = self.start_peak
+        self.start_cpu = sum(os.times()[:2])
+        self.start_wall = time.time()
+        return self
+        
+    def __exit__(self, exc_type, exc_value, tb):
+        wall_time = time.time() - self.start_wall
+        cpu_time = sum(os.times()[:2]) - self.start_cpu
+        rss, peak = rss_bytes()
+        self.peak = max(self.peak,peak)
+        profile_stack.pop()
+        if profile_stack:
+            profile_stack[-1].peak = max(profile_stack[-1].peak,self.peak)
+        
+        if profile_records is not None:
+            profile_records.append({'fly':self.fly,'stage':self.path,'pid':os.getpid(),
+                                    'start':self.start_wall,'wall_time':wall_time,
+                                    'cpu_time':cpu_time,
+                                    'peak_rss_delta':self.peak - self.start_peak,
+                                    'rss_delta':rss - self.start_rss,
+                                    'failed':exc_type is not None})
+        return False
+        
+class Unprofiled_Stage():
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+unprofiled_stage = Unprofiled_Stage()
+
+def profile_stage(stage, fly=''):
+    #with profile_stage(name, fly): ... -- the block is recorded as a stage 
+    #while profiling. otherwise this costs one global lookup
+    if profile_records is None:
+        return unprofiled_stage
+    return Profiled_Stage(stage,fly)
+    
+def profiled(func):
+    #decorator -- each call of func is a stage named after it. calls on a 
+    #Phys_Flight are labelled with its recording
+    @functools.wraps(func)
+    def profiled_func(*args, **kwargs):
+        if profile_records is None:
+            return func(*args, **kwargs)
+        fly = ''
+        if args and isinstance(args[0],Phys_Flight):
+            fly = os.path.basename(args[0].fname)
+        with Profiled_Stage(func.__name__,fly):
+            return func(*args, **kwargs)
+    return profiled_func
+
+def profiled_fly_call(fly_call):
+    #worker side of map_flies while profiling -- run one task and send its 
+    #stage records back with the result
+    global profile_records
+    fly_func, fly_task = fly_call
+    profile_records = []
+    result = fly_func(fly_task)
+    return result, profile_records
 
 #---------------------------------------------------------------------------#
 
 class Phys_Flight():  
+    chunk_size = 2**20 #samples per chunk for full-length passes
+    
     def __init__(self, fname):
         if fname.endswith('.abf'):
             self.basename = ''.join(fname.split('.')[:-1])
@@ -30,83 +199,397 @@ class Phys_Flight():
             self.basename = fname
             self.fname = self.basename + '.abf'  #check here for fname type 
                   
-    def open_abf(self,exclude_indicies=[]):        
-        abf = read_abf(self.fname)              
+    @profiled
+    def open_abf(self,exclude_indicies=[],use_cache=True):        
+        #channels are not read here. each one is built on first use (see 
+        #__getattr__), so a fly only pays for the signals an analysis touches
+        self.reset_channels()
+        if use_cache:
+            abf = read_abf_cached(self.fname)
+        else:
+            abf = read_abf(self.fname)              
         
-        # added features to exclude specific time intervals
+        # added features to exclude specific time intervals. exclude_indicies 
+        # can be (start, stop) intervals, as in the fly catalog, or sample indicies.
+        # channels are built from contiguous slices -- views when nothing is excluded
         n_indicies = np.size(abf['x_ch']) #assume all channels have the same sample #s 
-        inc_indicies = np.setdiff1d(range(n_indicies),exclude_indicies);
-                   
-        self.xstim = np.array(abf['x_ch'])[inc_indicies]
-        self.ystim = np.array(abf['y_ch'])[inc_indicies]
-
-        self.samples = np.arange(self.xstim.size)  #this is adjusted
-        self.t = self.samples/float(10000) # sampled at 10,000 hz -- encode here?
- 
-        #now process wing signal
-        lwa_v = np.array(abf['wba_l'])[inc_indicies]
-        rwa_v = np.array(abf['wba_r'])[inc_indicies]
-        
-        self.lwa = process_wings(lwa_v)
-        self.rwa = process_wings(rwa_v)
+        self._abf = abf
+        self._intervals = included_intervals(n_indicies,exclude_indicies)
+        self.n_samples = int(sum([stop - start for start, stop in self._intervals]))
         
-        lmr = self.lwa - self.rwa
-        self.raw_lmr = lmr
-        self.lmr = lmr
-        
-        self.ao = np.array(abf['patid'])[inc_indicies]
-        
-        self.vm = np.array(abf['vm'])[inc_indicies] - 13 #offset for bridge potential
-        self.tach = np.array(abf['tach'])[inc_indicies]
         self.n_nonflight_trs = 0 #will update
+        self.flight_windows = None #computed once, on the first flight check
+        self.stage_cache_key = None #set when the stages are run through the stage cache
+        
+    def reset_channels(self):
+        #forget the open recording and any channels already built from it
+        for name in self.channel_loaders.keys() + ['_abf','_intervals']:
+            self.__dict__.pop(name,None)
+        self.pyramid = {}
+        if '_stream_dir' in self.__dict__:
+            shutil.rmtree(self.__dict__.pop('_stream_dir'),ignore_errors=True)
+        
+    def get_channel(self, name, rate=10000):
+        #a channel at 10 khz or at a decimated rate (1000, 100, ... hz). each 
+        #level is anti-alias filtered and decimated by 10 from the level above,
+        #computed once and cached in self.pyramid
+        if rate == 10000:
+            return getattr(self,name)
+        if (name,rate) in self.pyramid:
+            return self.pyramid[(name,rate)]
+        
+        factor = 10000/float(rate)
+        if rate < 1 or factor != 10**int(round(math.log10(factor))):
+            raise ValueError('rate must be 10000 hz divided by a power of 10, not ' + str(rate))
+        
+        upper_rate = rate*10
+        upper = self.get_channel(name,upper_rate)
+        if name in stepped_channels:
+            #stimulus codes -- keep the steps sharp, no filtering
+            decimated = np.array(upper[::10])
+        else:
+            #8th order butterworth at 80% of the new nyquist frequency
+            decimated = np.array(sos_filter(upper,.4*rate,upper_rate,8)[::10])
+        self.pyramid[(name,rate)] = decimated
+        return decimated
+        
+    def reset_pyramid(self, name):
+        #drop the decimated levels of a channel, e.g. after it is cleaned
+        for key in self.pyramid.keys():
+            if key[0] == name:
+                del self.pyramid[key]
+        
+    def __getattr__(self, name):
+        #only called for attributes that are not set yet -- build lazy channels
+        if name in Phys_Flight.channel_loaders and '_abf' in self.__dict__:
+            with profile_stage('load ' + name,os.path.basename(self.fname)):
+                value = Phys_Flight.channel_loaders[name](self)
+            self.__dict__[name] = value
+            return value
+        raise AttributeError(name)
+        
+    def included_channel(self, ch):
+        #stored channels are scaled slice by slice, straight to float32
+        channel = self._abf[ch]
+        if not isinstance(channel,Scaled_Channel):
+            channel = np.asarray(channel)
+        return included_samples(channel,self._intervals,0,self.n_samples)
+        
+    def _load_samples(self):
+        return np.arange(self.n_samples)  #this is adjusted
+    
+    def _load_t(self):
+        return self.samples/float(10000) # sampled at 10,000 hz -- encode here?
+        
+    def _load_xstim(self):
+        return self.included_channel('x_ch')
+        
+    def _load_ystim(self):
+        return self.included_channel('y_ch')
+        
+    def _load_lwa(self):
+        return process_wings(self.included_channel('wba_l'))
+        
+    def _load_rwa(self):
+        return process_wings(self.included_channel('wba_r'))
+        
+    def _load_raw_lmr(self):
+        return self.lwa - self.rwa
+        
+    def _load_lmr(self):
+        return self.raw_lmr #clean_lmr_signal makes the cleaned copy
+        
+    def _load_ao(self):
+        return self.included_channel('patid')
+        
+    def _load_vm(self):
+        return self.included_channel('vm') - 13 #offset for bridge potential
+        
+    def _load_tach(self):
+        return self.included_channel('tach')
+        
+    @profiled
+    def open_abf_streaming(self,exclude_indicies=[],chunk_size=2**20):
+        #out-of-core version of open_abf for very long recordings. channels are 
+        #read from the decoded-channel cache one chunk at a time, processed, and 
+        #written to memory mapped files in the cache folder. peak memory depends 
+        #on chunk_size, not on the length of the recording. each open gets its
+        #own folder of files, so flies streaming the same recording never share them
+        self.reset_channels()
+        abf = read_abf_cached(self.fname)
+        n_raw_samples = np.size(abf['x_ch'])
+        intervals = included_intervals(n_raw_samples,exclude_indicies)
+        n_samples = int(sum([stop - start for start, stop in intervals]))
+        
+        streams_dir = os.path.join(abf_cache_dir(self.fname),'streams')
+        if not os.path.exists(streams_dir):
+            os.makedirs(streams_dir)
+        stream_dir = tempfile.mkdtemp(prefix='stream_',dir=streams_dir)
+        streamed = {}
+        for name in ['xstim','ystim','lwa','rwa','raw_lmr','lmr','ao','vm','tach']:
+            streamed[name] = np.lib.format.open_memmap(os.path.join(stream_dir,name + '.npy'),
+                                mode='w+',dtype=np.float32,shape=(n_samples,))
+        
+        wing_lag = 12 #process_wings looks 12 samples ahead
+        for start, stop in chunk_bounds(n_samples,chunk_size):
+            read_stop = min(stop + wing_lag,n_samples)
             
-    def _is_flying(self, start_i, stop_i, percent_thres = .90):  #fix this critera
-        #check that animal is flying using the tachometer signal
-     
-        #iterate through the trace in steps of 25 ms (250 with typical 10,000 sampling rate)
-        #min flight rate of interest = 100 wing beats/s
-        tach_range_thres = 1.5 #2
-        stroke_range_thres = 1
-        step_size = 350 #250
-        i_steps = range(start_i,stop_i,step_size)
-        n_tests = np.size(i_steps)
-        flight_tests = np.ones(n_tests, dtype=bool)    
-        
-        #check tachometer, but also make sure flight track is on. 
-        for interval_start,test_i in zip(i_steps,range(n_tests)):
-            interval = np.arange(interval_start,(interval_start+step_size))
-            interval_min = np.min(self.tach[interval])
-            interval_max = np.max(self.tach[interval])
-            stroke_min = np.min(self.lmr[interval])
-            stroke_max = np.max(self.lmr[interval])
+            streamed['xstim'][start:stop] = included_samples(abf['x_ch'],intervals,start,stop)
+            streamed['ystim'][start:stop] = included_samples(abf['y_ch'],intervals,start,stop)
             
-            tach_flight = (interval_max - interval_min) > tach_range_thres
-            stroke_flight = (stroke_max - stroke_min) > stroke_range_thres
+            lwa = process_wings(included_samples(abf['wba_l'],intervals,start,read_stop))[:stop-start]
+            rwa = process_wings(included_samples(abf['wba_r'],intervals,start,read_stop))[:stop-start]
+            streamed['lwa'][start:stop] = lwa
+            streamed['rwa'][start:stop] = rwa
+            streamed['raw_lmr'][start:stop] = lwa - rwa
+            streamed['lmr'][start:stop] = lwa - rwa
             
-            flight_tests[test_i] = tach_flight and stroke_flight
-        
-        is_flying = np.nanmean(flight_tests) > percent_thres 
-        return is_flying
+            streamed['ao'][start:stop] = included_samples(abf['patid'],intervals,start,stop)
+            streamed['vm'][start:stop] = included_samples(abf['vm'],intervals,start,stop) - 13 #offset for bridge potential
+            streamed['tach'][start:stop] = included_samples(abf['tach'],intervals,start,stop)
+            
+        for name in streamed:
+            streamed[name].flush()
+            setattr(self,name,streamed[name])
+            
+        #mapped files stay readable after they are removed (posix), and their 
+        #space is freed once the fly lets go of them. where mapped files cannot 
+        #be removed, reset_channels removes them
+        shutil.rmtree(stream_dir,ignore_errors=True)
+        if os.path.exists(stream_dir):
+            self._stream_dir = stream_dir
+        
+        self.n_samples = n_samples
+        self.t = Sample_Times(n_samples) #no full length time base
+        self.chunk_size = chunk_size
+        self.n_nonflight_trs = 0 #will update
+        self.flight_windows = None #computed once, on the first flight check
+        self.stage_cache_key = None
+            
+    def get_flight_windows(self, step_size = 350):
+        #one pass over the whole recording -- test every step_size window once
+        #and keep the cumulative sum of flight tests for fast per-trial lookups
+        self.flight_windows = flight_window_tests(self.tach,self.lmr,step_size,self.chunk_size)
+        self.flight_step_size = step_size
+        self.flight_cumsum = np.hstack((0,np.cumsum(self.flight_windows)))
+        
+    def flight_fractions(self, start_is, stop_is):
+        #fraction of flight windows between each start and stop index.
+        #windows are aligned to the recording, not to the trial start
+        if self.flight_windows is None:
+            self.get_flight_windows()
+        
+        n_windows = np.size(self.flight_windows)
+        first_win = np.clip(np.asarray(start_is)//self.flight_step_size,0,n_windows)
+        last_win = np.clip(-(-np.asarray(stop_is)//self.flight_step_size),0,n_windows)
+        n_tests = last_win - first_win
+        
+        n_flight = self.flight_cumsum[last_win] - self.flight_cumsum[first_win]
+        return n_flight/np.maximum(n_tests,1).astype(float)
+            
+    def _is_flying(self, start_i, stop_i, percent_thres = .90):  #fix this critera
+        #check that animal is flying using the tachometer signal
+        return self.flight_fractions(start_i,stop_i) > percent_thres
+
+#one row per parsed trial of a Looming_Phys fly. exclusion is '' for included
+#trials, or the reason, e.g. 'nonflight'. saccade_latency is in samples after 
+#the trial start, nan until find_saccade_latencies
+trial_dtype = [('start',int),('stop',int),('stim_type',int),('ao_code',float),
+               ('flight_frac',float),('exclusion','S16'),('saccade_latency',float)]
+               
+def new_trial_table(tr_starts, tr_stops):
+    trial_table = np.zeros(np.size(tr_starts),dtype=trial_dtype)
+    trial_table['start'] = tr_starts
+    trial_table['stop'] = tr_stops
+    trial_table['stim_type'] = -1
+    for field in ['ao_code','flight_frac','saccade_latency']:
+        trial_table[field] = np.nan
+    return trial_table
+
+#stim type labels of each experiment protocol (the type column of the fly 
+#catalog), in the order of the sorted ao codes. the catalog's looming-bright, 
+#looming-right-fast, part2 and part3 flies have no table yet -- their stim 
+#types are labelled by ao code, with a warning
+looming_labels = ['left, 22 l/v','left, 44 l/v','left, 88 l/v',
+                  'center, 22 l/v','center, 44 l/v','center, 88 l/v',
+                  'right, 22 l/v','right, 44 l/v','right, 88 l/v']
+stim_label_tables = {'looming':looming_labels}
+                     
+def stim_type_labels(protocol, ao_codes):
+    if protocol not in stim_label_tables:
+        warnings.warn('no stim type labels for protocol ' + repr(protocol) + 
+                      ' -- labelled by ao code, add its table to stim_label_tables')
+        return ['ao ' + str(code) for code in ao_codes]
+    label_table = stim_label_tables[protocol]
+    if len(label_table) < np.size(ao_codes):
+        print 'more stim types than ' + protocol + ' labels: ' + str(np.size(ao_codes))
+    return list(label_table)
+    
+#sorted ao codes (see trial_ao_codes) of the stim types of each protocol, in the 
+#order of its label table. a protocol without one falls back on the ranks of the 
+#codes of all parsed trials
+stim_ao_code_tables = {}
+stim_ao_code_tol = .05 #half the rounding step of trial_ao_codes
+
+def table_stim_types(ao_codes, table_codes):
+    #index of the table code matching each ao code, -1 for nan or unknown codes.
+    #nan table codes (stim types without a known code) match nothing
+    ao_codes = np.asarray(ao_codes,dtype=float)
+    table_codes = np.asarray(table_codes,dtype=float)
+    stim_types = -1*np.ones(np.size(ao_codes),'int')
+    code_is = np.where(~np.isnan(ao_codes))[0]
+    if not np.size(table_codes) or not np.size(code_is):
+        return stim_types
+    dists = np.abs(ao_codes[code_is,np.newaxis] - table_codes[np.newaxis,:])
+    dists[:,np.isnan(table_codes)] = np.inf
+    nearest = np.argmin(dists,axis=1)
+    is_match = dists[np.arange(np.size(code_is)),nearest] <= stim_ao_code_tol
+    stim_types[code_is[is_match]] = nearest[is_match]
+    return stim_types
+    
+def fly_stim_ao_codes(fly):
+    #ao code of each stim type of a fly after parse_stim_type, nan for types it 
+    #lacks -- e.g. to seed Online_Looming with the codes of a reference recording
+    trial_table = fly.trial_table
+    n_types = max(len(fly.stim_types_labels),np.max(np.hstack((trial_table['stim_type'],-1))) + 1)
+    stim_ao_codes = np.nan*np.ones(n_types)
+    is_typed = trial_table['stim_type'] >= 0
+    stim_ao_codes[trial_table['stim_type'][is_typed]] = trial_table['ao_code'][is_typed]
+    return stim_ao_codes
+    
+def catalog_protocol(catalog_row):
+    #experiment protocol of a fly catalog row (its type column), looming if 
+    #the catalog has none
+    protocol = catalog_row.get('type')
+    if protocol is None or pd.isnull(protocol):
+        return 'looming'
+    return protocol
+    
+def trial_ao_codes(ao, tr_starts, tr_stops):
+    #round(mean ao, 1) of each trial [start, stop). the sums come from one 
+    #np.add.reduceat over the trial bounds instead of a slice per trial. 
+    #trials must be sorted and not overlap; empty trials are nan
+    tr_starts = np.asarray(tr_starts,dtype=int)
+    tr_stops = np.asarray(tr_stops,dtype=int)
+    codes = np.nan*np.ones(np.size(tr_starts))
+    if not np.size(tr_starts):
+        return codes
+    
+    bounds = np.vstack((tr_starts,tr_stops)).T.ravel()
+    if bounds[-1] >= np.size(ao): #the last sum runs to the end anyway
+        bounds = bounds[:-1]
+    sums = np.add.reduceat(ao,bounds,dtype=np.float64)[::2]
+    
+    lengths = tr_stops - tr_starts
+    has_samples = lengths > 0
+    means = sums[has_samples]/lengths[has_samples]
+    codes[has_samples] = [round(mean,1) for mean in means] #same rounding as before
+    return codes
+
+#channels holding discrete codes, decimated without anti-alias filtering
+stepped_channels = ['ao']
+
+#channel name -> loader, used by Phys_Flight.__getattr__
+Phys_Flight.channel_loaders = {'samples':Phys_Flight._load_samples,
+                               't':Phys_Flight._load_t,
+                               'xstim':Phys_Flight._load_xstim,
+                               'ystim':Phys_Flight._load_ystim,
+                               'lwa':Phys_Flight._load_lwa,
+                               'rwa':Phys_Flight._load_rwa,
+                               'raw_lmr':Phys_Flight._load_raw_lmr,
+                               'lmr':Phys_Flight._load_lmr,
+                               'ao':Phys_Flight._load_ao,
+                               'vm':Phys_Flight._load_vm,
+                               'tach':Phys_Flight._load_tach}
         
            
 #---------------------------------------------------------------------------#
 
 class Looming_Phys(Phys_Flight):
     
-    def process_fly(self,ex_i=[]):  #does this interfere with the Flight_Phys init?
-        self.open_abf(ex_i)
+    def __init__(self, fname, protocol='looming'):
+        #protocol is the key of the stim label table, see stim_label_tables
+        Phys_Flight.__init__(self,fname)
+        self.protocol = protocol
+    
+    #the trial table and the per-trial arrays kept in step with it
+    trial_attrs = ['trial_table','n_trs','n_nonflight_trs','tr_starts','tr_stops','stim_types']
+    
+    @profiled
+    def process_fly(self,ex_i=[],iti=750,use_cache=True):  #does this interfere with the Flight_Phys init?
+        #with use_cache, the outputs of each stage are kept in the stage cache 
+        #next to the recording. only the stages whose inputs or parameters 
+        #changed are recomputed -- e.g. a new iti reruns the flight check and after
+        self.open_abf(ex_i,use_cache)
+        if not use_cache:
+            self.clean_lmr_signal()
+            self.parse_trial_times(iti=iti)
+            self.parse_stim_type()
+            return
+        
+        self.stage_cache_key = stage_key(abf_source_key(self.fname),'recording',
+                                         [stage_cache_version,np.asarray(self._intervals).tolist()])
+        self.cached_stage('lmr',{'fill':'hold'},self.clean_lmr_signal,
+                          ['lmr','artifact_report'])
+        self.cached_stage('trials',{},lambda: self.parse_trial_times(remove_non_flight=False),
+                          self.trial_attrs)
+        self.cached_stage('flight',{'iti':iti},lambda: self.remove_non_flight_trs(iti),
+                          self.trial_attrs)
+        #keyed by the contents of the protocol's tables, so editing them is a miss
+        stim_ao_codes = stim_ao_code_tables.get(self.protocol)
+        stim_params = {'protocol':self.protocol,
+                       'labels':stim_label_tables.get(self.protocol),
+                       'ao_codes':None if stim_ao_codes is None else np.asarray(stim_ao_codes,dtype=float).tolist(),
+                       'ao_code_tol':stim_ao_code_tol}
+        self.cached_stage('stim',stim_params,self.parse_stim_type,
+                          self.trial_attrs + ['stim_types_labels'])
+        
+    def cached_stage(self, stage, params, compute_stage, attr_names):
+        #run one processing stage, or restore its outputs (attr_names) from the
+        #stage cache. each key chains the key of the stage before, so a change 
+        #upstream also invalidates everything downstream
+        key = stage_key(self.stage_cache_key,stage,params)
+        with profile_stage('stage ' + stage,os.path.basename(self.fname)):
+            outputs = load_stage(self.fname,stage,key)
+            if outputs is None:
+                self.computing_stage = stage
+                try:
+                    compute_stage()
+                finally:
+                    self.computing_stage = None
+                outputs = dict([(name,getattr(self,name)) for name in attr_names])
+                save_stage(self.fname,stage,key,outputs)
+            else:
+                for name in outputs:
+                    self.reset_pyramid(name)
+                self.__dict__.update(outputs)
+                self.flight_windows = None
+        self.stage_cache_key = key
+        
+    def leave_stage_cache(self):
+        #a stage run by hand, not through cached_stage, makes the cached outputs
+        #after it (e.g. the traces of get_traces_by_stim) stale
+        if self.__dict__.get('computing_stage') is None:
+            self.stage_cache_key = None
+        
+    @profiled
+    def process_fly_streaming(self,ex_i=[],chunk_size=2**20):
+        #same stages as process_fly, but channels live in memory mapped files and
+        #every full-length pass (artifacts, trial edges, flight tests) is chunked
+        self.open_abf_streaming(ex_i,chunk_size)
         self.clean_lmr_signal()
         self.parse_trial_times()
         self.parse_stim_type()
         
-    def show_nonflight_exclusion(self,title_txt=''):
+    def show_nonflight_exclusion(self,title_txt='',out_dir=None):
         fig = plt.figure(figsize=(17.5,4.5))
         plt.title(title_txt)
         
         #plt.plot(self.tach*2-75,color=purple)
-        plt.plot(self.raw_lmr[::10],color=blue)
-        plt.plot(self.lmr,color=magenta)
-        plt.plot(self.ao-100,color=black)
+        ax = plt.gca()
+        lod_plot(ax,self.raw_lmr,color=blue)
+        lod_plot(ax,self.lmr,color=magenta)
+        lod_plot(ax,self.ao-100,color=black)
         plt.plot(self.tr_starts,np.ones_like(self.tr_starts),'oc')
         plt.ylabel('WBA (Degrees)')
         plt.xlabel('Samples (at 10,000 hz)')
@@ -123,92 +606,132 @@ class Looming_Phys(Phys_Flight):
         plt.legend(handles=[blue_line,magenta_line,purple_line,black_line,cyan_pt], prop = fontP, \
                             bbox_to_anchor=(1.025, 1), loc=2, borderaxespad=0.)
         
-        saveas_path = '/Users/jamie/bin/figures/'
+        saveas_path = figure_dir(out_dir)
         plt.savefig(saveas_path + title_txt + '_nonflight exclusion.png',bbox_inches='tight',dpi=100) 
         
         
         
         
-    def clean_lmr_signal(self,title_txt='',if_plot=False):
-        lmr = np.copy(self.lmr)
-        cleaned_lmr = np.copy(lmr) # make a copy here
-        
-        d_lmr = np.diff(lmr)
-        artifacts = np.where(abs(d_lmr) > 35)[0]-1
-    
-        if np.size(artifacts) >= 1:
-            artifact_gap_start_is = np.where(np.diff(artifacts) > .1*10000)[0]+1
-            artifact_gap_start_is = np.hstack((0,artifact_gap_start_is))  # add first start
-    
-            artifact_gap_stop_is = artifact_gap_start_is[1:]-1
-            artifact_gap_stop_is = np.hstack((artifact_gap_stop_is,np.size(artifacts)-1)) # add last
-
-            # now loop though all of these blanked periods, fill with previous/last real value
-            for start_i, stop_i in zip(artifact_gap_start_is,artifact_gap_stop_is):
-                fill_i = artifacts[start_i] - 1
-                if fill_i < 0: 
-                    fill_i = lmr_stop_i[stop_i] + 1
-            
-                lmr_start_i = artifacts[start_i]
-                lmr_stop_i = artifacts[stop_i] + 10
-        
-                cleaned_lmr[lmr_start_i:lmr_stop_i] = cleaned_lmr[fill_i]
+    @profiled
+    def clean_lmr_signal(self,title_txt='',if_plot=False,fill='hold',verbose=False):
+        #blank the periods around large jumps in the l-r signal. 
+        #fill = 'hold' keeps the last real value, 'linear' interpolates across.
+        #the gaps are summarized in self.artifact_report (printed if verbose)
+        self.leave_stage_cache()
+        lmr = self.lmr
+        if self.lmr is self.raw_lmr:
+            cleaned_lmr = np.copy(lmr) # make a copy here
+        else:
+            cleaned_lmr = lmr # already a separate buffer (streaming), clean in place 
+        
+        artifacts = lmr_artifacts(lmr,self.chunk_size)
+        gap_starts, gap_stops = artifact_gaps(artifacts,np.size(lmr))
+        fill_gaps(cleaned_lmr,gap_starts,gap_stops,fill)
+        
+        gap_durs = (gap_stops - gap_starts)/float(10000)
+        self.artifact_report = {'n_artifacts':np.size(artifacts),
+                                'n_gaps':np.size(gap_starts),
+                                'gap_durs':gap_durs,
+                                'total_dur':np.sum(gap_durs)}
+        if verbose:
+            print 'artifact gaps : ' + str(np.size(gap_starts)) + ', ' + \
+                  str(round(np.sum(gap_durs),2)) + ' s'
             
         if if_plot:
             fig = plt.figure()
-            plt.plot(lmr,color=blue)
+            lod_plot(plt.gca(),self.raw_lmr,color=blue)
             
-            if artifacts:
-                plt.plot(artifacts,lmr[artifacts],'*c')
-                plt.plot(artifacts[artifact_gap_start_is],np.ones_like(artifact_gap_start_is),'og')
-                plt.plot(artifacts[artifact_gap_stop_is]+10,np.ones_like(artifact_gap_stop_is),'om')
-            plt.plot(cleaned_lmr,color=purple)
+            if np.size(artifacts):
+                plt.plot(artifacts,self.raw_lmr[artifacts],'*c')
+                plt.plot(gap_starts,np.ones_like(gap_starts),'og')
+                plt.plot(gap_stops,np.ones_like(gap_stops),'om')
+            lod_plot(plt.gca(),cleaned_lmr,color=purple)
             plt.title(title_txt)
             
             # also show nonflight periods here
 
         self.lmr = cleaned_lmr
+        self.flight_windows = None #lmr changed, so retest flight
+        self.reset_pyramid('lmr')
           
+    @profiled
     def remove_non_flight_trs(self, iti=750):
         # loop through each trial and determine whether fly was flying continuously
         # if a short nonflight bout (but not during turn window), interpolate
         #
-        # delete the trials with long nonflight bouts--change n_trs, tr_starts, 
-        # tr_stops, looming stim on
-        
-        non_flight_trs = [];
+        # trials with long nonflight bouts are flagged in the trial table, not 
+        # deleted -- n_trs, tr_starts, tr_stops only hold the included trials
         
-        for tr_i in range(self.n_trs):
-            this_tr_start = self.tr_starts[tr_i] - iti
-            this_tr_stop = self.tr_stops[tr_i] + iti
-            
-            if not self._is_flying(this_tr_start,this_tr_stop, percent_thres = .90):
-                non_flight_trs.append(tr_i) 
+        #flight fractions for all trials come from one whole-recording pass
+        self.leave_stage_cache()
+        trial_table = self.trial_table
+        flight_fracs = self.flight_fractions(trial_table['start'] - iti,trial_table['stop'] + iti)
+        trial_table['flight_frac'] = flight_fracs
+        non_flight_trs = np.where(~(flight_fracs > .90) & (trial_table['exclusion'] == ''))[0]
+        trial_table['exclusion'][non_flight_trs] = 'nonflight'
         
         #print 'nonflight trials : ' + ', '.join(str(x) for x in non_flight_trs)
         
-        print 'nonflight trials : ' + str(np.size(non_flight_trs)) + '/' + str(self.n_trs)
-        
-        #now remove these
-        self.n_nonflight_trs = np.size(non_flight_trs)
-        self.n_trs = self.n_trs - np.size(non_flight_trs)
-        self.tr_starts = np.delete(self.tr_starts,non_flight_trs)  #index values of starting and stopping
-        self.tr_stops = np.delete(self.tr_stops,non_flight_trs)
-        #self.pre_loom_stim_ons = np.delete(self.pre_loom_stim_ons,non_flight_trs)
+        print 'nonflight trials : ' + str(np.size(non_flight_trs)) + '/' + str(len(trial_table))
+        self.set_trial_table(trial_table)
+        
+    def set_trial_table(self, trial_table):
+        #the trial table is the index of the fly's trials, one row per parsed 
+        #trial -- excluded ones too, with their reason. n_trs, tr_starts, 
+        #tr_stops and stim_types are the included trials, kept in step with it
+        self.trial_table = trial_table
+        included = trial_table['exclusion'] == ''
+        self.n_trs = int(np.sum(included))
+        self.n_nonflight_trs = int(np.sum(trial_table['exclusion'] == 'nonflight'))
+        self.tr_starts = trial_table['start'][included]  #index values of starting and stopping
+        self.tr_stops = trial_table['stop'][included]
+        self.stim_types = trial_table['stim_type'][included]
+        
+    def trial_mask(self, stim_type=None, included=True, max_saccade_latency=None):
+        #boolean mask over the trial table. stim_type can be one type or a list,
+        #max_saccade_latency is in samples after the trial start. any other 
+        #selection is a mask on the table fields, e.g. fly.trial_table['flight_frac'] > .95
+        trial_table = self.trial_table
+        mask = np.ones(len(trial_table),dtype=bool)
+        if included:
+            mask &= trial_table['exclusion'] == ''
+        if stim_type is not None:
+            mask &= np.in1d(trial_table['stim_type'],np.atleast_1d(stim_type))
+        if max_saccade_latency is not None:
+            if not self.__dict__.get('has_saccade_latencies',False):
+                self.find_saccade_latencies()
+            with np.errstate(invalid='ignore'):
+                mask &= trial_table['saccade_latency'] < max_saccade_latency
+        return mask
+        
+    @profiled
+    def find_saccade_latencies(self, iti=25000):
+        #first saccade start after each included trial's start, in samples. 
+        #nan for trials without one
+        trial_traces, trial_info = self.get_trial_tensor(iti,['lmr'])
+        saccades = find_saccades_batch(trial_traces[:,:,0])
+        saccades = saccades[saccades['start'] >= iti] #sorted by trial, then time
+        first = np.hstack((True,np.diff(saccades['tr']) != 0))[:np.size(saccades)]
+        
+        latencies = np.nan*np.ones(len(trial_info))
+        latencies[saccades['tr'][first]] = saccades['start'][first] - iti
+        self.trial_table['saccade_latency'] = np.nan
+        self.trial_table['saccade_latency'][trial_info['tr_i'].values] = latencies
+        self.has_saccade_latencies = True
                     
-    def parse_trial_times(self, if_debug_fig=False):
+    @profiled
+    def parse_trial_times(self, if_debug_fig=False, iti=750, remove_non_flight=True):
         #parse the ao signal to determine trial start and stop index values
         #include checks for unusual starting aos, early trial ends, 
         #long itis, etc
+        self.leave_stage_cache()
         
-        ao_diff = np.diff(self.ao)
+        tr_start, tr_stop = ao_trial_edges(self.ao,self.chunk_size)
         
-        tr_start = self.samples[np.where(ao_diff > 5)]
         start_diff = np.diff(tr_start)
         redundant_starts = tr_start[np.where(start_diff < 1000)]
         clean_tr_starts = np.setdiff1d(tr_start,redundant_starts)+1
         
-        tr_stop = self.samples[np.where(ao_diff <= -4)]
         stop_diff = np.diff(tr_stop)
         redundant_stops = tr_stop[np.where(stop_diff < 1000)] 
         #now check that the y value is > 0 
@@ -224,21 +747,20 @@ class Looming_Phys(Phys_Flight):
         if clean_tr_starts[-1] > clean_tr_stops[-1]:
             clean_tr_starts = np.delete(clean_tr_starts,len(clean_tr_starts)-1)
          
-        #should check for same # of starts and stops
+        #the same # of starts and stops is checked below, after the debug figure
         n_trs = len(clean_tr_starts)
         
         if if_debug_fig:
             figd = plt.figure()
-            plt.plot(self.ao)
-            plt.plot(ao_diff,color=magenta)
+            lod_plot(plt.gca(),self.ao)
+            lod_plot(plt.gca(),np.diff(self.ao),color=magenta)
             y_start = np.ones(len(clean_tr_starts))
             y_stop = np.ones(len(clean_tr_stops))
             plt.plot(clean_tr_starts,y_start*7,'go')
             plt.plot(clean_tr_stops,y_stop*7,'ro')
         
         #detect when the y stim stepped
-        ystim_diff = np.diff(self.ystim)
-        y_step = self.samples[np.where(ystim_diff > .03)]
+        #y_step = np.where(np.diff(self.ystim) > .03)[0]
 
         ##now discriminate first stim on for a trial, not looming steps
         #pre_loom_stim = np.zeros(n_trs)
@@ -252,54 +774,49 @@ class Looming_Phys(Phys_Flight):
         
         #next encode post loom stim on, iti_dur as the median
         
-        self.n_trs = n_trs 
-        self.tr_starts = clean_tr_starts  #index values of starting and stopping
-        self.tr_stops = clean_tr_stops
+        #a missed start or stop would pair every later start with the wrong stop
+        if n_trs != len(clean_tr_stops):
+            raise ValueError(str(n_trs) + ' trial starts but ' + str(len(clean_tr_stops)) + 
+                             ' trial stops in ' + self.fname + ' -- check the ao signal (if_debug_fig=True)')
+        self.set_trial_table(new_trial_table(clean_tr_starts,clean_tr_stops))
+        self.has_saccade_latencies = False
         #self.pre_loom_stim_ons = pre_loom_stim
         
         #here remove all trials in which the fly is not flying. 
-        self.remove_non_flight_trs()
+        if remove_non_flight:
+            self.remove_non_flight_trs(iti)
         
+    @profiled
     def parse_stim_type(self):
-        #calculate the stimulus type
+        #calculate the stimulus type of each trial from its rounded mean ao, with 
+        #the ao code table of the fly's protocol (see stim_ao_code_tables). without
+        #a table the codes of all parsed trials, excluded ones too, are ranked --
+        #a condition missing from the whole recording would shift the types above
+        #it, which is warned about. labels come from the protocol's label table
         
         #self.n_trs = 70 #hack to deal with the crash ------ remove this *******************
-       
-        stim_types_labels = []
-        stim_types_labels.append('left, 22 l/v')
-        stim_types_labels.append('left, 44 l/v') 
-        stim_types_labels.append('left, 88 l/v')
+        self.leave_stage_cache()
         
-        stim_types_labels.append('center, 22 l/v')
-        stim_types_labels.append('center, 44 l/v')
-        stim_types_labels.append('center, 88 l/v')
+        trial_table = self.trial_table
+        tr_ao_codes = trial_ao_codes(self.ao,trial_table['start'],trial_table['stop'])
         
-        stim_types_labels.append('right, 22 l/v')
-        stim_types_labels.append('right, 44 l/v')
-        stim_types_labels.append('right, 88 l/v')
-        
-        stim_types = -1*np.ones(self.n_trs,'int')
-        
-        tr_ao_codes = np.empty(self.n_trs)
-        
-        #first loop through to get the unique ao values
-        for tr in range(self.n_trs): 
-            this_start = self.tr_starts[tr]
-            this_stop = self.tr_stops[tr]
-            tr_ao_codes[tr] = round(np.mean(self.ao[this_start:this_stop]),1)   
-        unique_tr_ao_codes = np.unique(tr_ao_codes) 
-        
-        for tr in range(self.n_trs): 
-            tr_ao_code = tr_ao_codes[tr]         
-            
-            if not np.isnan(tr_ao_code):
-                stim_types[tr] = int(np.where(unique_tr_ao_codes == tr_ao_code)[0])
-                
-        
-        self.stim_types = stim_types  #change to integer, although nans are also useful
-        self.stim_types_labels = stim_types_labels
+        if self.protocol in stim_ao_code_tables:
+            stim_ao_codes = stim_ao_code_tables[self.protocol]
+        else:
+            stim_ao_codes = np.unique(tr_ao_codes[~np.isnan(tr_ao_codes)])
+            n_labels = len(stim_label_tables.get(self.protocol,stim_ao_codes))
+            if np.size(stim_ao_codes) != n_labels:
+                warnings.warn(str(np.size(stim_ao_codes)) + ' ao codes for ' + str(n_labels) + 
+                              ' ' + self.protocol + ' stim types in ' + self.fname + 
+                              ' -- the ranked types may be shifted, add the protocol\'s codes' + 
+                              ' to stim_ao_code_tables')
+        
+        trial_table['ao_code'] = tr_ao_codes
+        trial_table['stim_type'] = table_stim_types(tr_ao_codes,stim_ao_codes)
+        self.set_trial_table(trial_table)
+        self.stim_types_labels = stim_type_labels(self.protocol,stim_ao_codes)
            
-    def plot_wba_stim(self,title_txt=[],wba_lim=[-60,60],if_save=True):
+    def plot_wba_stim(self,title_txt=[],wba_lim=[-60,60],if_save=True,out_dir=None):
         #plot the stimuli and wba traces for each of the nine conditions
         #add text to annotate the filename, genotype
         #ideally there would be less whitespace between the wba and stim figures and more 
@@ -315,7 +832,7 @@ class Looming_Phys(Phys_Flight):
             grid_row = int(2*math.floor(cnd/3))
             grid_col = int(cnd%3)
         
-            this_cnd_trs = np.where(self.stim_types == cnd)[0]
+            this_cnd_trs = np.where(self.trial_mask(stim_type=cnd))[0]
             n_cnd_trs = np.size(this_cnd_trs)
             
             #get colormap info
@@ -329,8 +846,8 @@ class Looming_Phys(Phys_Flight):
             x_lim = [0, 3]
                
             for tr, i in zip(this_cnd_trs,range(n_cnd_trs)):
-                this_start = self.tr_starts[tr] - s_iti
-                this_stop =  self.tr_stops[tr] + s_iti
+                this_start = self.trial_table['start'][tr] - s_iti
+                this_stop =  self.trial_table['stop'][tr] + s_iti
                 this_color = scalarMap.to_rgba(i)        
                 
                 #plot WBA signal -----------------------------------------------------------    
@@ -339,7 +856,7 @@ class Looming_Phys(Phys_Flight):
                 baseline = np.nanmean(wba_trace[baseline_win])
                 wba_trace = wba_trace - baseline
                 
-                wba_ax.plot(self.t[this_start:this_stop]-self.t[this_start],wba_trace,color=this_color)
+                lod_plot(wba_ax,self.t[this_start:this_stop]-self.t[this_start],wba_trace,color=this_color,xlim=x_lim)
                 
                 #plot black line for 0 -------------------------------
                 wba_ax.axhline(color=black)
@@ -358,7 +875,7 @@ class Looming_Phys(Phys_Flight):
                       
                 #now plot stimulus traces -----------------------------------------------------
                 stim_ax = plt.subplot(gs[grid_row+1,grid_col])
-                stim_ax.plot(self.t[this_start:this_stop]-self.t[this_start],self.ystim[this_start:this_stop],color=this_color)
+                lod_plot(stim_ax,self.t[this_start:this_stop]-self.t[this_start],self.ystim[this_start:this_stop],color=this_color,xlim=x_lim)
                 
                 #set x and y lim -------------------------------
                 stim_ax.set_xlim(x_lim)
@@ -388,12 +905,12 @@ class Looming_Phys(Phys_Flight):
         plt.draw()
         
         if if_save:
-            saveas_path = '/Users/jamie/bin/figures/'
+            saveas_path = figure_dir(out_dir)
             plt.savefig(saveas_path + title_txt + '_looming_wings.png',dpi=100)
             #plt.close('all')
     
     def plot_vm_wba_stim(self,title_txt='',vm_base_subtract = True,l_div_v_list=[0,1,2],
-        vm_lim=[-90,-40],wba_lim=[-60,60],if_save=False): 
+        vm_lim=[-90,-40],wba_lim=[-60,60],if_save=False,out_dir=None): 
         #for each l/v stim parameter, 
         #make figure three rows of signals -- vm, wba, stimulus x
         #three columns of looming direction
@@ -415,7 +932,7 @@ class Looming_Phys(Phys_Flight):
                 #here row is manually set -- corresponds to the signal
                 #column is in the loop
                 
-                this_cnd_trs = np.where(self.stim_types == cnd)[0]
+                this_cnd_trs = np.where(self.trial_mask(stim_type=cnd))[0]
                 n_cnd_trs = np.size(this_cnd_trs)
             
                 #get colormap info
@@ -430,8 +947,8 @@ class Looming_Phys(Phys_Flight):
                 x_lim = [0, 4+loom_speed]
                
                 for tr, i in zip(this_cnd_trs,range(n_cnd_trs)):
-                    this_start = self.tr_starts[tr] - s_iti
-                    this_stop =  self.tr_stops[tr] + s_iti
+                    this_start = self.trial_table['start'][tr] - s_iti
+                    this_stop =  self.trial_table['stop'][tr] + s_iti
                     this_color = scalarMap.to_rgba(i)        
                     
                     #plot Vm signal ______________________________________________________
@@ -445,7 +962,7 @@ class Looming_Phys(Phys_Flight):
                         vm_trace = vm_trace - vm_base
                         
                     
-                    vm_ax.plot(self.t[this_start:this_stop]-self.t[this_start],vm_trace,color=this_color)
+                    lod_plot(vm_ax,self.t[this_start:this_stop]-self.t[this_start],vm_trace,color=this_color,xlim=x_lim)
                 
                     #set x and y lim
                     vm_ax.set_ylim(vm_lim) 
@@ -469,7 +986,7 @@ class Looming_Phys(Phys_Flight):
                     baseline = np.nanmean(wba_trace[baseline_win])
                     wba_trace = wba_trace - baseline
                 
-                    wba_ax.plot(self.t[this_start:this_stop]-self.t[this_start],moving_average(wba_trace,200),color=this_color)
+                    lod_plot(wba_ax,self.t[this_start:this_stop]-self.t[this_start],moving_average(wba_trace,200),color=this_color,xlim=x_lim)
                 
                     #plot black line for 0 
                     wba_ax.axhline(color=black)
@@ -489,7 +1006,7 @@ class Looming_Phys(Phys_Flight):
                       
                     #now plot stimulus traces ____________________________________________
                     stim_ax = plt.subplot(gs[2,grid_col])
-                    stim_ax.plot(self.t[this_start:this_stop]-self.t[this_start],self.ystim[this_start:this_stop],color=this_color)
+                    lod_plot(stim_ax,self.t[this_start:this_stop]-self.t[this_start],self.ystim[this_start:this_stop],color=this_color,xlim=x_lim)
                 
                     #set x and y lim
                     stim_ax.set_xlim(x_lim)
@@ -516,16 +1033,19 @@ class Looming_Phys(Phys_Flight):
             plt.draw()
             
             if if_save:
-                saveas_path = '/Users/jamie/bin/figures/'
+                saveas_path = figure_dir(out_dir)
                 plt.savefig(saveas_path + figure_txt + '_looming_vm_wings.png',dpi=100)
                 #plt.close('all')        
         
     def plot_vm_wba_stim_corr(self,title_txt='',vm_base_subtract=True,l_div_v_list=[0,1,2],
-        vm_lim=[-80,-50],wba_lim=[-45,45],if_save=True,if_x_zoom=True,if_summer_exp=False): 
+        vm_lim=[-80,-50],wba_lim=[-45,45],if_save=True,if_x_zoom=True,if_summer_exp=False,
+        n_perms=0,n_boots=0,n_workers=1,out_dir=None): 
         
         # for each l/v stim parameter, 
         # make figure four rows of signals -- vm, wba, stimulus, vm-wba corr x
         # three columns of looming direction
+        # n_perms/n_boots > 0 add the permutation p and bootstrap ci of each 
+        # correlation (see corr_significance), at the cost of resampling every trace
         
         sampling_rate = 10000 # in hertz
         s_iti = 2 * sampling_rate
@@ -586,6 +1106,12 @@ class Looming_Phys(Phys_Flight):
             
             max_t = int(loom_max_i + 1*sampling_rate)
             
+            # x range that will be shown, for level of detail plotting
+            if if_x_zoom:
+                x_zoom = l_div_v_zoom_win[loom_speed]
+            else:
+                x_zoom = [0,max_t]
+            
             # now loop through the conditions/columns. ____________________________________
             # the signal types are encoded in separate rows(vm, wba, stim, corr)
             for cnd, grid_col in zip(cnds_to_plot,range(n_x)):
@@ -627,7 +1153,7 @@ class Looming_Phys(Phys_Flight):
                         vm_trace = vm_trace - vm_base
                     
                     non_nan_i = np.where(~np.isnan(vm_trace))[0]  #I shouldn't need these. remove nans earlier. ****************
-                    vm_ax.plot(vm_trace[non_nan_i],color=this_color)
+                    lod_plot(vm_ax,vm_trace[non_nan_i],color=this_color,xlim=x_zoom)
                     
                     #filtered_vm_trace = butter_lowpass_filter(vm_trace[non_nan_i],10)
                     #vm_ax.plot(filtered_vm_trace,color=this_color)
@@ -644,94 +1170,52 @@ class Looming_Phys(Phys_Flight):
                      
                     non_nan_i = np.where(~np.isnan(wba_trace))[0]  ##remove nans earlier/check to make sure nans only occur at the end
                     filtered_wba_trace = butter_lowpass_filter(wba_trace[non_nan_i],30)
-                    wba_ax.plot(filtered_wba_trace,color=this_color)
+                    lod_plot(wba_ax,filtered_wba_trace,color=this_color,xlim=x_zoom)
 
                     # plot all saccade times
                     wba_ax.plot(tr_saccades,filtered_wba_trace[tr_saccades],marker='^', \
                                 markersize=8.5,linestyle='',color=this_color)
                     
                     #now plot stimulus traces ____________________________________________
-                    stim_ax.plot(all_fly_traces.loc[:,('this_fly',tr,cnd,'ystim')],color=this_color)
+                    lod_plot(stim_ax,all_fly_traces.loc[:,('this_fly',tr,cnd,'ystim')],color=this_color,xlim=x_zoom)
                                   
                 
                 # select the saccades latencies to consider ______________________________
-        
-                # get the saccade times in range
                 cnd_saccade_times = all_fly_saccades.loc[:,('this_fly',slice(None),cnd)].values
-                l_bound = cnd_saccade_times > l_saccade_win
-                r_bound = cnd_saccade_times < r_saccade_win
-                bound_conj = l_bound * r_bound
-                selected_saccade_times = cnd_saccade_times * bound_conj #out of range times are zeroed out
-                
-                # remove nans, since they do not play well with many numpy functions
-                nan_is = np.isnan(selected_saccade_times)
-                selected_saccade_times[nan_is] = 0
-                
-                # now get the index of the first saccade latency in the time window
-                r_is = np.nanargmax(selected_saccade_times,0)
-                first_saccades_times = selected_saccade_times[r_is,np.arange(np.size(r_is))]
-                
-                # exclude time 0 saccades -- out of range or nan
-                nonzero_samples = np.nonzero(first_saccades_times)
-                r_is_nonzero = r_is[nonzero_samples]
-                c_is_nonzero = nonzero_samples
-                
-                saccade_latencies_to_analyze = selected_saccade_times[r_is_nonzero,c_is_nonzero]
-                        # do I need to do feature scaling here? 
+                saccade_latencies = saccade_latencies_in_win(cnd_saccade_times,l_saccade_win,r_saccade_win)
                 
                 # get saccade displacements ______________________________________________ 
-                # calc max within 
-                lmr_baseline_win = np.arange(loom_max_i-15000,loom_max_i-5001)
-                
-                lmr_baseline_mean = np.nanmean(all_fly_traces.loc[baseline_win,('this_fly',slice(None),cnd,'lmr')],0)
-                lmr_turn_win_traces = all_fly_traces.loc[this_turn_win,('this_fly',slice(None),cnd,'lmr')].as_matrix()
-                delta_lmr_traces = lmr_turn_win_traces - lmr_baseline_mean
-                
-                # filter, take the absolute value for each trial 
-                filtered_delta_lmr_traces = np.empty_like(delta_lmr_traces)
-                for tr_i in range(np.shape(delta_lmr_traces)[1]):
-                    filtered_delta_lmr_traces[:,tr_i] = np.abs(butter_lowpass_filter(delta_lmr_traces[:,tr_i],30))
-            
-                # now find the max displacement during the saccade window for each trace
-                lmr_turn_abs_max  = np.max(filtered_delta_lmr_traces,0)
+                lmr_traces = all_fly_traces.loc[:,('this_fly',slice(None),cnd,'lmr')].values
+                lmr_turn_abs_max = turn_magnitudes(lmr_traces,baseline_win,this_turn_win)
                 for i in range(np.size(lmr_turn_abs_max)):
                     wba_ax.plot(loom_max_i,lmr_turn_abs_max[i],marker='_', \
                     color=scalarMap.to_rgba(i),markersize=20) 
                 
                 # calculate, plot correlations for all traces/cnd ________________________   
-                vm_baseline = np.nanmean(all_fly_traces.loc[baseline_win,('this_fly',slice(None),cnd,'vm')],0)
-                
-                step_size = 1000
-                t_steps = range(0,max_t,step_size)  
-                step_win = 2000
+                vm_traces = all_fly_traces.loc[:,('this_fly',slice(None),cnd,'vm')].values
+                corr_df = vm_behavior_corr(vm_traces,
+                                           {'latency':saccade_latencies-s_iti, #should I subtract?
+                                            'magnitude':lmr_turn_abs_max},
+                                           baseline_win,max_t,n_perms=n_perms,
+                                           n_boots=n_boots,n_workers=n_workers)
                 
-                for t_start in t_steps:
-                    t_stop = t_start+step_win
-                    t_plot = (t_start+(step_size/2.0))
+                for measure, c, dot_size in [('latency','b',5),('magnitude','m',6)]:
+                    this_corr = corr_df[corr_df['measure'] == measure]
+                    t_plot = this_corr['t_plot'].values
+                    r = this_corr['r'].values
+                    p = this_corr['p'].values
+                    if n_perms: #corrected for the comparisons across windows
+                        p = this_corr['p_corr'].values
                     
-                    this_vm = np.nanmean(all_fly_traces.loc[:,('this_fly',slice(None),cnd,'vm')][t_start:t_stop],0)
-                    delta_vm = this_vm-vm_baseline
-                    
-                    # correlate vm with saccade latencies ________________________________
-                    r,p = sp.stats.pearsonr(delta_vm[c_is_nonzero], \
-                                            selected_saccade_times[r_is_nonzero,c_is_nonzero][0]-s_iti) #should I subtract?
-                    corr_ax.plot(t_plot,r,'.b',markersize=5)
-                    if p < 0.01: #if significant without correcting for many comparisons
-                        corr_ax.plot(t_plot,r,'+b',markersize=10,markeredgewidth=1.5) 
-                    elif p < 0.05:
-                        corr_ax.plot(t_plot,r,'xb',markersize=10,markeredgewidth=1.5)
-                        corr_ax.plot(t_plot,r,'+b',markersize=10,markeredgewidth=1.5)
-                    
-                    # correlate vm with saccade magnitude ________________________________
-                    # exclude trials with nan. later process wings without nans
-                    non_nan = np.where(~np.isnan(lmr_turn_abs_max))[0]  
-                    r,p = sp.stats.pearsonr(delta_vm[non_nan],lmr_turn_abs_max[non_nan])
-                    corr_ax.plot(t_plot,r,'.m')
-                    if p < 0.01: #if significant without correcting for many comparisons
-                        corr_ax.plot(t_plot,r,'+m',markersize=10,markeredgewidth=1.5) 
-                    elif p < 0.05: 
-                        corr_ax.plot(t_plot,r,'+m',markersize=10,markeredgewidth=1.5)
-                        corr_ax.plot(t_plot,r,'xm',markersize=10,markeredgewidth=1.5)
+                    if n_boots:
+                        corr_ax.vlines(t_plot,this_corr['r_lo'].values,this_corr['r_hi'].values,
+                                       color=c,alpha=.3)
+                    corr_ax.plot(t_plot,r,'.'+c,markersize=dot_size)
+                    with np.errstate(invalid='ignore'):
+                        sig_01 = p < 0.01
+                        sig_05 = (p >= 0.01) & (p < 0.05)
+                    corr_ax.plot(t_plot[sig_01 | sig_05],r[sig_01 | sig_05],'+'+c,markersize=10,markeredgewidth=1.5)
+                    corr_ax.plot(t_plot[sig_05],r[sig_05],'x'+c,markersize=10,markeredgewidth=1.5)
                                     
             #now format all subplots _____________________________________________________  
            
@@ -828,7 +1312,7 @@ class Looming_Phys(Phys_Flight):
             plt.draw()
             
             if if_save:
-                saveas_path = '/Users/jamie/bin/figures/'
+                saveas_path = figure_dir(out_dir)
                 if if_x_zoom:
                     plt.savefig(saveas_path + figure_txt + '_looming_vm_wings_corr_zoomed.png',\
                     bbox_inches='tight',dpi=100) 
@@ -869,24 +1353,80 @@ class Looming_Phys(Phys_Flight):
             
                 this_cnd_trs = all_fly_traces.loc[:,('this_fly',slice(None),cnd,'lmr')].columns.get_level_values(1).tolist()
                 n_cnd_trs = np.size(this_cnd_trs)
+                
+                #detect saccades for all trials of the condition at once _____________
+                wba_traces = all_fly_traces.loc[:,('this_fly',slice(None),cnd,'lmr')].values
+                baseline = np.nanmean(wba_traces[baseline_win,:],0)
+                wba_traces = wba_traces - baseline  #always subtract the baseline here
+                saccades, filtered_traces = find_saccades_batch(wba_traces,axis=0,return_filtered=True)
             
                 #loop single trials and plot all signals _________________________________
-                for tr in this_cnd_trs:
+                for tr, tr_i in zip(this_cnd_trs,range(n_cnd_trs)):
                     
                     #plot Vm signal ______________________________________________________      
                     #vm_trace = all_fly_traces.loc[:,('this_fly',tr,cnd,'vm')]
                     
                     #plot WBA signal _____________________________________________________           
-                    wba_trace = all_fly_traces.loc[:,('this_fly',tr,cnd,'lmr')]
-                    baseline = np.nanmean(wba_trace[baseline_win])
-                    wba_trace = wba_trace - baseline  #always subtract the baseline here
+                    saccade_starts = saccades['start'][saccades['tr'] == tr_i]
                     
-                    saccade_time = find_saccades(wba_trace,True)
-                    plt.plot(all_fly_traces.loc[:,('this_fly',tr,cnd,'ystim')])
+                    fig = plt.figure()
+                    lod_plot(plt.gca(),wba_traces[:,tr_i],'grey')
+                    lod_plot(plt.gca(),filtered_traces[tr_i],'black')
+                    plt.plot(saccade_starts,filtered_traces[tr_i,saccade_starts],'mo')
+                    lod_plot(plt.gca(),all_fly_traces.loc[:,('this_fly',tr,cnd,'ystim')])
     
     
                    
-    def get_traces_by_stim(self,fly_name='this_fly',iti=25000,get_saccades=False):
+    @profiled
+    def get_trial_tensor(self,iti=25000,trace_names=['lmr','lwa','rwa','vm','ystim'],rate=10000,
+                         tr_mask=None):
+    #extract the traces for each trial into one preallocated array 
+    #(n_trs x n_samples x n_traces), aligned to iti samples before looming start.
+    #trials shorter than the longest, or cut off by the ends of the recording, 
+    #are padded with nans. also returns a table of trial info, one row per trial.
+    #iti and trial times are in 10 khz samples; rate picks a decimated level 
+    #of the channels (see get_channel) and the tensor is sampled at that rate.
+    #tr_mask selects rows of the trial table (see trial_mask), by default the 
+    #included trials. tr_i is the trial's row in the table
+        
+        pre_loom_stim_dur = 10000 #add this to the flies? 
+        factor = 10000//rate
+        
+        if tr_mask is None:
+            tr_mask = self.trial_mask()
+        tr_rows = np.where(tr_mask)[0]
+        n_trs = np.size(tr_rows)
+        
+        tr_starts = (self.trial_table['start'][tr_rows] - iti)//factor
+        tr_stops = (self.trial_table['stop'][tr_rows] + pre_loom_stim_dur)//factor
+        n_samples = int(np.max(tr_stops - tr_starts)) if n_trs else 0
+        
+        trial_traces = np.empty((n_trs,n_samples,len(trace_names)))
+        trial_traces.fill(np.nan)
+        
+        traces = [self.get_channel(name,rate) for name in trace_names]
+        n_recording = np.size(traces[0]) if traces else 0
+        for tr in range(n_trs):
+            #clip to the recording, keep the samples at their aligned position
+            this_start = max(tr_starts[tr],0)
+            this_stop = min(tr_stops[tr],n_recording)
+            if this_stop <= this_start:
+                continue
+            row_start = this_start - tr_starts[tr]
+            row_stop = row_start + this_stop - this_start
+            for trace_i, trace in enumerate(traces):
+                trial_traces[tr,row_start:row_stop,trace_i] = trace[this_start:this_stop]
+                
+        trial_info = pd.DataFrame({'tr_i':tr_rows,
+                                   'tr_type':self.trial_table['stim_type'][tr_rows],
+                                   'start':tr_starts,
+                                   'stop':tr_stops},
+                                   columns=['tr_i','tr_type','start','stop'])
+        return trial_traces, trial_info
+                   
+    @profiled
+    def get_traces_by_stim(self,fly_name='this_fly',iti=25000,get_saccades=False,rate=10000,
+                           tr_mask=None):
     #here extract the traces for each of the stimulus times. 
     #align to looming start, and add the first pre stim and post stim intervals
     #here return a data frame of lwa and rwa wing traces
@@ -894,56 +1434,56 @@ class Looming_Phys(Phys_Flight):
    
     #using a pandas data frame with multilevel indexing! rows = time in ms
     #columns are multileveled -- genotype, fly, trial index, trial type, trace
+    #the data frame is built once, from the preallocated trial tensor, for the 
+    #trials selected by tr_mask (see get_trial_tensor)
+        
+        if tr_mask is None:
+            tr_mask = self.trial_mask()
+        if self.stage_cache_key is not None:
+            traces_key = stage_key(self.stage_cache_key,'traces',
+                                   {'fly_name':fly_name,'iti':iti,'get_saccades':get_saccades,'rate':rate,
+                                    'tr_rows':np.where(tr_mask)[0].tolist()})
+            outputs = load_stage(self.fname,'traces',traces_key)
+            if outputs is not None:
+                return outputs['traces']
+        
+        trace_names = ['lmr','lwa','rwa','vm','ystim']
+        trial_traces, trial_info = self.get_trial_tensor(iti,trace_names,rate,tr_mask)
+        n_trs, n_samples, n_traces = np.shape(trial_traces)
+        
+        column_labels = pd.MultiIndex.from_arrays([[fly_name]*(n_trs*n_traces),
+                                                   np.repeat(trial_info['tr_i'].values,n_traces),
+                                                   np.repeat(trial_info['tr_type'].values,n_traces),
+                                                   trace_names*n_trs],
+                                                   names=['fly','tr_i','tr_type','trace']) 
+                                                        #is the unsorted tr_type level a problem?    
+        
+        #(samples x trials*traces), trial-major to keep each trial's traces together
+        fly_df = pd.DataFrame(trial_traces.transpose(1,0,2).reshape(n_samples,n_trs*n_traces),
+                              columns=column_labels)
         
-        pre_loom_stim_dur = 10000 #add this to the flies? 
-        
-        fly_df = pd.DataFrame()
-        fly_saccades_df = pd.DataFrame() #keep empty if not tracking all saccades
-       
-        for tr in range(self.n_trs):
-            this_loom_start = self.tr_starts[tr]
-            this_start = this_loom_start - iti
-            this_stop = self.tr_stops[tr] + pre_loom_stim_dur
-            
-            this_stim_type = self.stim_types[tr]
-            iterables = [[fly_name],
-                         [tr],
-                         [this_stim_type],
-                         ['lmr','lwa','rwa','vm','ystim']]
-            column_labels = pd.MultiIndex.from_product(iterables,names=['fly','tr_i','tr_type','trace']) 
-                                                            #is the unsorted tr_type level a problem?    
-            
-            
-            tr_traces = np.asarray([self.lmr[this_start:this_stop],
-                                         self.lwa[this_start:this_stop],
-                                         self.rwa[this_start:this_stop],
-                                         self.vm[this_start:this_stop],
-                                         self.ystim[this_start:this_stop]]).transpose()  #reshape to avoid transposing
-                                          
-            tr_df = pd.DataFrame(tr_traces,columns=column_labels) #,index=time_points) 
-            fly_df = pd.concat([fly_df,tr_df],axis=1)
-            
-            
-            if get_saccades:
-                # make a data structure of saccade times in the same format as the 
-                # fly_df trace information
-                # data = saccade start times. now not trying to define saccade stops
-                # rows = saccade number
-                # columns = fly, trial index, trial type
-                
-                 iterables = [[fly_name],
-                             [tr],
-                             [this_stim_type]]
-                 column_labels = pd.MultiIndex.from_product(iterables,names=['fly','tr_i','tr_type']) 
-                                                             
-                 saccade_starts = find_saccades(self.lmr[this_start:this_stop])
-                 tr_saccade_starts_df = pd.DataFrame(np.transpose(saccade_starts),columns=column_labels)            
-                 fly_saccades_df = pd.concat([fly_saccades_df,tr_saccade_starts_df],axis=1)
-            
         if get_saccades:
-            return fly_df, fly_saccades_df 
+            # make a data structure of saccade times in the same format as the 
+            # fly_df trace information
+            # data = saccade start times. now not trying to define saccade stops
+            # rows = saccade number
+            # columns = fly, trial index, trial type
+            # all trials in one batch, keeping the tensor's sample indexing
+            saccades = find_saccades_batch(trial_traces[:,:,trace_names.index('lmr')],fs=rate)
+            saccade_starts = saccades_by_tr(saccades,n_trs,'start')
+            
+            column_labels = pd.MultiIndex.from_arrays([[fly_name]*n_trs,
+                                                       trial_info['tr_i'].values,
+                                                       trial_info['tr_type'].values],
+                                                       names=['fly','tr_i','tr_type']) 
+            fly_saccades_df = pd.DataFrame(saccade_starts,columns=column_labels)
+            traces = (fly_df, fly_saccades_df)
         else:  
-            return fly_df
+            traces = fly_df
+        
+        if self.stage_cache_key is not None:
+            save_stage(self.fname,'traces',traces_key,{'traces':traces})
+        return traces
         
      
         
@@ -976,21 +1516,300 @@ def xcorr(a, v):
     xc = np.correlate(a, v, mode='same')
     return xc
     
+@profiled
 def read_abf(abf_filename):
-        fh = AxonIO(filename=abf_filename)
-        segments = fh.read_block().segments
+        #channels as Scaled_Channels -- the raw ADC samples of the recording with
+        #the gain and offset of its header, the same values neo's AxonIO scales to
+        fh = AxonRawIO(filename=abf_filename)
+        fh.parse_header()
     
-        if len(segments) > 1:
+        if fh.segment_count(0) > 1:
             print 'More than one segment in file.'
             return 0
 
-        analog_signals_ls = segments[0].analogsignals
+        raw_signals = fh.get_analogsignal_chunk(block_index=0,seg_index=0)
         analog_signals_dict = {}
-        for analog_signal in analog_signals_ls:
-            analog_signals_dict[analog_signal.name.lower()] = analog_signal
+        for ch_i, signal_channel in enumerate(fh.header['signal_channels']):
+            analog_signals_dict[signal_channel['name'].lower()] = \
+                Scaled_Channel(np.array(raw_signals[:,ch_i]),signal_channel['gain'],signal_channel['offset'])
 
         return analog_signals_dict
         
+class Sample_Times():
+    #stands in for np.arange(n_samples)/fs without allocating the time base
+    def __init__(self, n_samples, fs=10000):
+        self.n_samples = n_samples
+        self.size = n_samples
+        self.fs = float(fs)
+        
+    def __len__(self):
+        return self.n_samples
+        
+    def __getitem__(self, i):
+        if isinstance(i,slice):
+            return np.arange(*i.indices(self.n_samples))/self.fs
+        return np.arange(self.n_samples)[i]/self.fs if np.ndim(i) else i/self.fs
+    
+def chunk_bounds(n_samples, chunk_size):
+    #start, stop of each chunk. a short final chunk is merged into the one before
+    chunk_starts = range(0,n_samples,chunk_size)
+    if len(chunk_starts) > 1 and n_samples - chunk_starts[-1] < chunk_size/2:
+        chunk_starts = chunk_starts[:-1]
+    chunk_stops = chunk_starts[1:] + [n_samples]
+    return zip(chunk_starts,chunk_stops)
+    
+def included_intervals(n_samples, exclude_indicies):
+    #convert the exclusions into (start, stop) intervals of the samples to keep.
+    #exclusions are either (start, stop) intervals (stop not included) or a list
+    #of sample indicies. cost scales with the number of exclusions
+    if np.ndim(exclude_indicies) == 2:
+        ex_intervals = np.asarray(exclude_indicies,dtype=int)
+        ex_starts = np.clip(ex_intervals[:,0],0,n_samples)
+        ex_stops = np.clip(ex_intervals[:,1],0,n_samples)
+    else:
+        exclude_indicies = np.unique(np.asarray(exclude_indicies,dtype=int))
+        exclude_indicies = exclude_indicies[(exclude_indicies >= 0) & (exclude_indicies < n_samples)]
+        run_breaks = np.where(np.diff(exclude_indicies) > 1)[0]
+        ex_starts = exclude_indicies[np.hstack((0,run_breaks+1))] if exclude_indicies.size else exclude_indicies
+        ex_stops = exclude_indicies[np.hstack((run_breaks,-1))] + 1 if exclude_indicies.size else exclude_indicies
+    
+    not_empty = ex_stops > ex_starts
+    ex_starts = ex_starts[not_empty]
+    ex_stops = ex_stops[not_empty]
+    if not ex_starts.size:
+        return [(0,n_samples)]
+    
+    #sort and merge overlapping exclusions
+    order = np.argsort(ex_starts,kind='mergesort')
+    ex_starts = ex_starts[order]
+    ex_stops = np.maximum.accumulate(ex_stops[order])
+    new_run = np.hstack((True,ex_starts[1:] > ex_stops[:-1]))
+    ex_starts = ex_starts[new_run]
+    ex_stops = ex_stops[np.hstack((np.where(new_run)[0][1:]-1,-1))]
+    
+    inc_starts = np.hstack((0,ex_stops))
+    inc_stops = np.hstack((ex_starts,n_samples))
+    keep = inc_stops > inc_starts
+    return zip(inc_starts[keep].tolist(),inc_stops[keep].tolist())
+    
+def catalog_exclusions(catalog_row):
+    #(start, stop) exclusion intervals stored in a fly catalog row as
+    #ex_i_start1/ex_i_stop1, ex_i_start2/ex_i_stop2, ... empty fields are nan
+    intervals = []
+    i = 1
+    while ('ex_i_start%d' % i) in catalog_row:
+        start = catalog_row['ex_i_start%d' % i]
+        stop = catalog_row['ex_i_stop%d' % i]
+        if not (pd.isnull(start) or pd.isnull(stop)):
+            intervals.append((int(start),int(stop)))
+        i = i + 1
+    return intervals
+    
+def included_samples(channel, intervals, start, stop):
+    #samples start:stop of the channel with the excluded intervals cut out
+    inc_lengths = [inc_stop - inc_start for inc_start, inc_stop in intervals]
+    inc_offsets = np.hstack((0,np.cumsum(inc_lengths)))
+    
+    pieces = []
+    first = np.searchsorted(inc_offsets,start,side='right') - 1
+    for i in range(first,len(intervals)):
+        if inc_offsets[i] >= stop:
+            break
+        piece_start = intervals[i][0] + max(start - inc_offsets[i],0)
+        piece_stop = intervals[i][0] + min(stop - inc_offsets[i],inc_lengths[i])
+        pieces.append(channel[piece_start:piece_stop])
+    
+    if not pieces: #everything excluded, or an empty range
+        return np.asarray(channel[0:0])
+    if len(pieces) == 1:
+        return np.asarray(pieces[0])
+    return np.concatenate(pieces)
+    
+abf_cache_format = 2 #bump when the layout of the channel cache changes
+
+def abf_cache_dir(abf_filename):
+    #decoded channels are kept in a folder next to the recording
+    return abf_filename + '_cache'
+
+def abf_content_hash(abf_filename, block_size=2**22):
+    md5 = hashlib.md5()
+    with open(abf_filename,'rb') as f:
+        block = f.read(block_size)
+        while block:
+            md5.update(block)
+            block = f.read(block_size)
+    return md5.hexdigest()
+
+def abf_fingerprint(abf_filename, content_hash=None):
+    #path, size and mtime are cheap to check. the content hash is only
+    #computed when asked for, or when the cheap checks disagree with the cache
+    abf_stat = os.stat(abf_filename)
+    fingerprint = {'path':os.path.abspath(abf_filename),
+                   'size':abf_stat.st_size,
+                   'mtime':abf_stat.st_mtime,
+                   'md5':content_hash}
+    return fingerprint
+
+@profiled
+def read_abf_cached(abf_filename, rebuild=False):
+    #same channels as read_abf, but decoded once and stored as .npy files next 
+    #to the recording. later calls memory map these instead of decoding the abf.
+    #channels are stored as the raw samples with the header's gain and offset 
+    #(see read_abf) and returned as Scaled_Channels, which scale to float32
+    #only the samples that are read. channels that come as plain arrays are
+    #stored as float32.
+    #the cache is keyed by path, size, mtime and md5 of the recording and is 
+    #rebuilt whenever the recording changes
+    cache_dir = abf_cache_dir(abf_filename)
+    manifest_fname = os.path.join(cache_dir,'manifest.pkl')
+    fingerprint = abf_fingerprint(abf_filename)
+    
+    manifest = None
+    if not rebuild and os.path.exists(manifest_fname):
+        with open(manifest_fname,'rb') as f:
+            manifest = cPickle.load(f)
+        if manifest.get('format') != abf_cache_format: #an older layout of the cache
+            manifest = None
+    
+    if manifest is not None:
+        cached_fp = manifest['fingerprint']
+        same_stat = all([cached_fp[k] == fingerprint[k] for k in ['path','size','mtime']])
+        
+        if not same_stat:
+            #touched, copied or rewritten -- only trust the cache if the content matches
+            if cached_fp['size'] == fingerprint['size'] and \
+               cached_fp['md5'] == abf_content_hash(abf_filename):
+                manifest['fingerprint'].update(path=fingerprint['path'],mtime=fingerprint['mtime'])
+                write_pickle_atomically(manifest_fname,manifest)
+            else:
+                manifest = None
+    
+    if manifest is None:
+        abf = read_abf(abf_filename)
+        if not abf: 
+            return abf
+        
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            channel_names = sorted(abf.keys())
+            scales = {}
+            for ch in channel_names:
+                if isinstance(abf[ch],Scaled_Channel):
+                    raw = np.asarray(abf[ch].raw)
+                    scales[ch] = (float(abf[ch].gain),float(abf[ch].offset))
+                else:
+                    raw = np.asarray(abf[ch],dtype=np.float32)
+                    scales[ch] = (1.0,0.0)
+                write_npy_atomically(os.path.join(cache_dir,ch + '.npy'),raw)
+        except (IOError, OSError) as e:
+            print 'Could not write abf cache: ' + str(e)
+            return abf
+        
+        fingerprint['md5'] = abf_content_hash(abf_filename)
+        manifest = {'fingerprint':fingerprint,'channels':channel_names,'scales':scales,
+                    'format':abf_cache_format}
+        write_pickle_atomically(manifest_fname,manifest)
+        
+    analog_signals_dict = {}
+    for ch in manifest['channels']:
+        gain, offset = manifest['scales'][ch]
+        analog_signals_dict[ch] = Scaled_Channel(np.load(os.path.join(cache_dir,ch + '.npy'),mmap_mode='r'),
+                                                 gain,offset)
+    return analog_signals_dict
+    
+class Scaled_Channel():
+    #a channel as the abf stores it -- raw ADC samples (usually 16 bit, memory 
+    #mapped from the cache) plus gain and offset. indexing returns gain*raw + 
+    #offset in float32, so only the samples that are read are ever converted
+    def __init__(self, raw, gain=1.0, offset=0.0):
+        self.raw = raw
+        self.gain = np.float32(gain)
+        self.offset = np.float32(offset)
+        self.shape = np.shape(raw)
+        self.size = np.size(raw)
+        
+    def __len__(self):
+        return len(self.raw)
+        
+    def __getitem__(self, i):
+        return np.asarray(self.raw[i],dtype=np.float32)*self.gain + self.offset
+        
+    def __array__(self, dtype=None):
+        samples = self[:]
+        return samples if dtype is None else samples.astype(dtype)
+
+def abf_source_key(abf_filename):
+    #content hash of the recording. taken from the channel cache manifest 
+    #when that is current, so the recording is not re-read
+    manifest_fname = os.path.join(abf_cache_dir(abf_filename),'manifest.pkl')
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname,'rb') as f:
+            cached_fp = cPickle.load(f)['fingerprint']
+        fingerprint = abf_fingerprint(abf_filename)
+        if cached_fp['md5'] and all([cached_fp[k] == fingerprint[k] for k in ['path','size','mtime']]):
+            return cached_fp['md5']
+    return abf_content_hash(abf_filename)
+    
+stage_cache_version = 4 #bump when a stage's outputs change
+
+def stage_key(parent_key, stage, params):
+    #key of a processing stage's outputs -- the key of the stage it depends 
+    #on, the stage name and the stage's parameters
+    if isinstance(params,dict):
+        params = sorted(params.items())
+    return hashlib.md5(repr((parent_key,stage,params))).hexdigest()
+    
+def stage_dir(abf_filename, stage, key):
+    return os.path.join(abf_cache_dir(abf_filename),'stages',stage + '_' + key)
+    
+def load_stage(abf_filename, stage, key):
+    #outputs of a cached stage, or None. arrays are memory mapped copy-on-write,
+    #so a stage can still modify them without touching the cache
+    this_dir = stage_dir(abf_filename,stage,key)
+    outputs_fname = os.path.join(this_dir,'outputs.pkl')
+    if not os.path.exists(outputs_fname):
+        return None
+    with open(outputs_fname,'rb') as f:
+        outputs, array_names = cPickle.load(f)
+    for name in array_names:
+        outputs[name] = np.load(os.path.join(this_dir,name + '.npy'),mmap_mode='c')
+    return outputs
+    
+def save_stage(abf_filename, stage, key, outputs):
+    #numeric arrays are saved as .npy files, everything else is pickled. the
+    #pickle is written last, so a partly written stage is never loaded
+    this_dir = stage_dir(abf_filename,stage,key)
+    outputs = dict(outputs)
+    try:
+        if not os.path.exists(this_dir):
+            os.makedirs(this_dir)
+        array_names = [name for name in outputs if isinstance(outputs[name],np.ndarray) and
+                                                   outputs[name].dtype != object]
+        for name in array_names:
+            #written under a temporary name, so parallel writers of the same
+            #stage never leave a mixed file behind
+            write_npy_atomically(os.path.join(this_dir,name + '.npy'),outputs.pop(name))
+        write_pickle_atomically(os.path.join(this_dir,'outputs.pkl'),(outputs,array_names))
+    except (IOError, OSError) as e:
+        print 'Could not write stage cache: ' + str(e)
+
+def write_pickle_atomically(fname, obj):
+    #cache manifests and indexes are written last and atomically, so a 
+    #partially written cache is never read
+    tmp_fname = fname + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_fname,'wb') as f:
+        cPickle.dump(obj,f,cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_fname,fname)
+    
+def write_npy_atomically(fname, array):
+    #written under a temporary name of this process and renamed, so parallel
+    #writers never truncate a file another process has memory mapped
+    tmp_fname = fname + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_fname,'wb') as f:
+        np.save(f,array)
+    os.rename(tmp_fname,fname)
+        
 def process_wings(raw_wings):
     #here shift wing signal -12 ms in time, filling end with nans
     shifted_wings = np.zeros_like(raw_wings)
@@ -1001,52 +1820,202 @@ def process_wings(raw_wings):
     processed_wings = -45 + shifted_wings*33.75
     return processed_wings
      
-def find_saccades(raw_lmr_trace,test_plot=False):
-    #first fill in nans with nearest signal
-    lmr_trace = raw_lmr_trace[~np.isnan(raw_lmr_trace)] 
-        #this may give different indexing than input
-        #ideally fill in nans in wing processing
+def lmr_artifacts(lmr, chunk_size=2**20):
+    #indicies one before each jump > 35 degrees in the l-r signal.
+    #chunks overlap by one sample so no jump is missed at a boundary
+    artifacts = []
+    for start, stop in chunk_bounds(np.size(lmr),chunk_size):
+        d_lmr = np.diff(lmr[max(start-1,0):stop])
+        artifacts.append(np.where(abs(d_lmr) > 35)[0] + max(start-1,0) - 1)
+    return np.hstack(artifacts) if artifacts else np.array([],dtype=int)
+    
+def artifact_gaps(artifacts, n_samples, min_gap=1000, pad=10):
+    #group artifacts closer than min_gap samples into blanked periods. each 
+    #period runs from the first artifact to pad samples after the last one
+    if not np.size(artifacts):
+        return np.array([],dtype=int), np.array([],dtype=int)
+    
+    new_gap = np.hstack((True,np.diff(artifacts) > min_gap))
+    last_in_gap = np.hstack((new_gap[1:],True))
+    gap_starts = np.clip(artifacts[new_gap],0,n_samples)
+    gap_stops = np.clip(artifacts[last_in_gap] + pad,0,n_samples)
+    return gap_starts, gap_stops
+    
+def ranges_to_indicies(starts, stops):
+    #concatenated np.arange(start,stop) for all ranges, without a python loop
+    lengths = stops - starts
+    keep = lengths > 0
+    starts, stops, lengths = starts[keep], stops[keep], lengths[keep]
+    if not np.size(starts):
+        return np.array([],dtype=int)
+    
+    steps = np.ones(np.sum(lengths),dtype=int)
+    steps[0] = starts[0]
+    steps[np.cumsum(lengths)[:-1]] = starts[1:] - stops[:-1] + 1
+    return np.cumsum(steps)
+    
+def fill_gaps(trace, gap_starts, gap_stops, fill='hold'):
+    #fill the gaps in place. 'hold' repeats the last sample before each gap 
+    #(the first sample after it for a gap at the start), 'linear' interpolates
+    #between the samples on either side of the gap
+    n_samples = np.size(trace)
+    keep = gap_stops > gap_starts
+    gap_starts, gap_stops = gap_starts[keep], gap_stops[keep]
+    if not np.size(gap_starts):
+        return trace
+    
+    gap_lengths = gap_stops - gap_starts
+    gap_is = ranges_to_indicies(gap_starts,gap_stops)
+    
+    has_before = gap_starts > 0
+    has_after = gap_stops < n_samples
+    before = np.where(has_before,trace[np.maximum(gap_starts-1,0)],trace[np.minimum(gap_stops,n_samples-1)])
+    after = np.where(has_after,trace[np.minimum(gap_stops,n_samples-1)],before)
+    before = np.where(has_before,before,after)
+    
+    if fill == 'hold':
+        trace[gap_is] = np.repeat(before,gap_lengths)
+    elif fill == 'linear':
+        #position of each sample within its gap, from 1/(n+1) to n/(n+1)
+        gap_pos = gap_is - np.repeat(gap_starts-1,gap_lengths)
+        frac = gap_pos/np.repeat(gap_lengths+1.0,gap_lengths)
+        trace[gap_is] = np.repeat(before,gap_lengths)*(1-frac) + np.repeat(after,gap_lengths)*frac
+    else:
+        raise ValueError('unknown fill: ' + str(fill))
+    return trace
+    
+def ao_trial_edges(ao, chunk_size=2**20):
+    #candidate trial starts and stops from steps in the ao (patid) signal.
+    #chunks overlap by one sample so no step is missed at a boundary
+    tr_start = []
+    tr_stop = []
+    for start, stop in chunk_bounds(np.size(ao),chunk_size):
+        ao_diff = np.diff(ao[max(start-1,0):stop])
+        tr_start.append(np.where(ao_diff > 5)[0] + max(start-1,0))
+        tr_stop.append(np.where(ao_diff <= -4)[0] + max(start-1,0))
+    return np.hstack(tr_start).astype(int), np.hstack(tr_stop).astype(int)
+    
+def flight_window_tests(tach, lmr, step_size=350, chunk_size=2**20):
+    #split the recording into step_size windows and check the tachometer and
+    #l-r stroke ranges in each. the last window may be short.
+    #min flight rate of interest = 100 wing beats/s
+    tach_range_thres = 1.5 #2
+    stroke_range_thres = 1
+    
+    #whole windows per chunk so windows stay aligned to the recording 
+    chunk_size = max(chunk_size//step_size,1)*step_size
+    flight_tests = []
+    for start in range(0,np.size(tach),chunk_size):
+        tach_chunk = tach[start:start+chunk_size]
+        lmr_chunk = lmr[start:start+chunk_size]
+        window_starts = np.arange(0,np.size(tach_chunk),step_size)
+        
+        tach_range = np.maximum.reduceat(tach_chunk,window_starts) - \
+                     np.minimum.reduceat(tach_chunk,window_starts)
+        stroke_range = np.maximum.reduceat(lmr_chunk,window_starts) - \
+                       np.minimum.reduceat(lmr_chunk,window_starts)
+    
+        #check tachometer, but also make sure flight track is on. 
+        flight_tests.append((tach_range > tach_range_thres) & (stroke_range > stroke_range_thres))
+    return np.hstack(flight_tests) if flight_tests else np.array([],dtype=bool)
+    
+saccade_dtype = [('tr',int),('start',int),('stop',int),('magnitude',float)]
 
+def fill_nans(traces):
+    #fill nans along each row with the last real value (the first one for 
+    #leading nans), keeping the sample indexing. all-nan rows become 0
+    traces = np.array(traces,dtype=float,ndmin=2)
+    is_valid = ~np.isnan(traces)
+    if is_valid.all():
+        return traces, is_valid
+    n_samples = np.shape(traces)[1]
+    
+    last_valid = np.where(is_valid,np.arange(n_samples),0)
+    np.maximum.accumulate(last_valid,axis=1,out=last_valid)
+    first_valid = np.argmax(is_valid,axis=1)
+    use_first = ~is_valid & (np.arange(n_samples) < first_valid[:,np.newaxis])
+    last_valid[use_first] = np.repeat(first_valid,np.sum(use_first,axis=1))
+    
+    filled = traces[np.arange(np.shape(traces)[0])[:,np.newaxis],last_valid]
+    filled[np.isnan(filled)] = 0
+    return filled, is_valid
+
+@profiled
+def find_saccades_batch(lmr_traces,axis=-1,diff_thres=.01,refractory_period=.2*10000,
+                        return_filtered=False,fs=10000):
+    #saccades in a whole (n_trs x n_samples) matrix at once -- filtered along 
+    #axis in one call, thresholded and refractory-gated without python loops.
+    #nans are filled rather than dropped, so indicies match the input samples.
+    #returns a structured array, one row per saccade: trial (row), start and 
+    #stop sample, and magnitude (filtered l-r change from start to stop).
+    #diff_thres and refractory_period are per 10 khz sample and scaled to fs
+    lmr_traces = np.array(lmr_traces,dtype=float,ndmin=2)
+    if axis == 0 or axis == -2:
+        lmr_traces = lmr_traces.T
+    
+    filled_traces, is_valid = fill_nans(lmr_traces)
+    
+    diff_thres = diff_thres*10000/float(fs)
+    refractory_period = refractory_period*fs/10000.
+    
     # filter lmr signal
-    filtered_trace = butter_lowpass_filter(lmr_trace) #6 hertz
+    filtered_traces = butter_lowpass_filter(filled_traces,fs=fs) #6 hertz
     
-    # differentiate, take the absolute value
-    diff_trace = abs(np.diff(filtered_trace))
-     
-    # mark saccade start times -- this could be improved
-    diff_thres = .01
-    cross_d_thres = np.where(diff_trace > diff_thres)[0]
-    
-    # #use this to find saccade stops
-#     saccade_start_candidate = diff_trace[1:-1] < diff_thres  
-#     saccade_cont  = diff_trace[2:]   >= diff_thres
-#     stacked_start_cont = np.vstack([saccade_start,saccade_cont])
-#     candidate_saccade_starts = np.where(np.all(stacked_start_cont,axis=0))[0]
-    
-    # impose a refractory period for saccades
-    d_cross_d_thres = np.diff(cross_d_thres)
-    
-    refractory_period = .2 * 10000
-    if cross_d_thres.size:
-        saccade_starts = [cross_d_thres[0]] #include first
-        
-        #then take those with gaps between saccade events
-        other_is = np.where(d_cross_d_thres > refractory_period)[0]+1
-        saccade_starts = np.hstack((saccade_starts,cross_d_thres[other_is]))
-    else:
-        saccade_starts = []
+    # differentiate, take the absolute value. only between real samples
+    diff_traces = np.abs(np.diff(filtered_traces,axis=1))
+    cross_d_thres = (diff_traces > diff_thres) & is_valid[:,1:] & is_valid[:,:-1]
+    cross_trs, cross_is = np.nonzero(cross_d_thres) #row major -- sorted by trial, then time
+    
+    # impose a refractory period for saccades -- a saccade starts at the first 
+    # crossing of a trial or after a gap of more than refractory_period
+    # (trimmed to the crossings, so no crossings at all gives no saccades)
+    n_cross = np.size(cross_is)
+    new_tr = np.hstack((True,np.diff(cross_trs) != 0))[:n_cross]
+    new_saccade = new_tr | np.hstack((True,np.diff(cross_is) > refractory_period))[:n_cross]
+    last_in_saccade = np.hstack((new_saccade[1:],True))[:n_cross]
+    
+    saccades = np.zeros(np.sum(new_saccade),dtype=saccade_dtype)
+    saccades['tr'] = cross_trs[new_saccade]
+    saccades['start'] = cross_is[new_saccade]
+    saccades['stop'] = cross_is[last_in_saccade] + 1
+    saccades['magnitude'] = filtered_traces[saccades['tr'],saccades['stop']] - \
+                            filtered_traces[saccades['tr'],saccades['start']]
+    
+    if return_filtered:
+        return saccades, filtered_traces
+    return saccades
+    
+def saccades_by_tr(saccades, n_trs, field='start'):
+    #(max n saccades x n_trs) array of one saccade field, nan padded
+    counts = np.bincount(saccades['tr'],minlength=n_trs)
+    by_tr = np.empty((max(np.max(counts) if n_trs else 0,0),n_trs))
+    by_tr.fill(np.nan)
+    
+    tr_first = np.hstack((0,np.cumsum(counts)[:-1]))
+    saccade_n = np.arange(np.size(saccades)) - tr_first[saccades['tr']]
+    by_tr[saccade_n,saccades['tr']] = saccades[field]
+    return by_tr
+    
+@profiled
+def find_saccades(raw_lmr_trace,test_plot=False):
+    #saccade start indicies of a single trace. see find_saccades_batch
+    saccades, filtered_trace = find_saccades_batch(raw_lmr_trace,return_filtered=True)
+    saccade_starts = saccades['start']
        
     if test_plot:
-        fig = plt.figure()
-        plt.plot(lmr_trace,'grey')
-        plt.plot(filtered_trace,'black')
-        plt.plot(1000*diff_trace,'green')
+        filtered_trace = filtered_trace[0]
+        diff_trace = abs(np.diff(filtered_trace))
         
+        fig = plt.figure()
+        lod_plot(plt.gca(),raw_lmr_trace,'grey')
+        lod_plot(plt.gca(),filtered_trace,'black')
+        lod_plot(plt.gca(),1000*diff_trace,'green')
         
+        cross_d_thres = np.where(diff_trace > .01)[0]
         plt.plot(cross_d_thres,np.zeros_like(cross_d_thres),'r.')
         plt.plot(saccade_starts,np.ones_like(saccade_starts),'mo')
     
-    # return indicies of start and stop times + saccade magnitude 
+    # return indicies of start times. find_saccades_batch also has stops + magnitudes 
     return saccade_starts
        
 def butter_lowpass(cutoff, fs, order=5):
@@ -1055,11 +2024,229 @@ def butter_lowpass(cutoff, fs, order=5):
     b, a = sp.signal.butter(order, normal_cutoff, btype='low', analog=False)
     return b, a
 
-def butter_lowpass_filter(data, cutoff=6, fs=10000, order=5): #how does the order change?
-    b, a = butter_lowpass(cutoff, fs, order)
-    #y = sp.signal.lfilter(b, a, data) #what's the difference here? 
-    y = sp.signal.filtfilt(b, a, data)
-    return y
+filter_bank = {} #(btype, cutoff(s), fs, order) -> second-order sections
+
+def butter_sos(cutoff, fs=10000, order=5, btype='low'):
+    #butterworth filter as second-order sections, designed once per 
+    #(btype, cutoff, fs, order) and then reused. sos stays numerically stable
+    #for low cutoffs at 10 khz, where (b, a) of order 5 does not
+    key = (btype,tuple(np.atleast_1d(cutoff).tolist()),fs,order)
+    if key not in filter_bank:
+        nyq = 0.5 * fs
+        normal_cutoff = np.asarray(cutoff,dtype=float) / nyq
+        filter_bank[key] = sp.signal.butter(order, normal_cutoff, btype=btype, 
+                                            analog=False, output='sos')
+    return filter_bank[key]
+    
+def sos_filter(data, cutoff, fs=10000, order=5, btype='low', axis=-1):
+    #zero-phase filtering along any axis, so a whole batch of trials is one call
+    sos = butter_sos(cutoff, fs, order, btype)
+    return sp.signal.sosfiltfilt(sos, data, axis=axis)
+
+def butter_lowpass_filter(data, cutoff=6, fs=10000, order=5, axis=-1): #how does the order change?
+    return sos_filter(data, cutoff, fs, order, 'low', axis)
+    
+def butter_highpass_filter(data, cutoff, fs=10000, order=5, axis=-1):
+    #e.g. to remove slow drift from vm
+    return sos_filter(data, cutoff, fs, order, 'high', axis)
+    
+def butter_bandpass_filter(data, low_cutoff, high_cutoff, fs=10000, order=5, axis=-1):
+    return sos_filter(data, [low_cutoff, high_cutoff], fs, order, 'band', axis)
+      
+def saccade_latencies_in_win(saccade_times, l_win, r_win):
+    #saccade_times = (n saccades x n_trs) saccade starts, nan padded. for each 
+    #trial, the latest saccade start inside (l_win, r_win); nan if there is none
+    with np.errstate(invalid='ignore'):
+        in_win = (saccade_times > l_win) & (saccade_times < r_win) 
+    selected_saccade_times = np.where(in_win,saccade_times,0) #out of range or nan times are zeroed out
+    
+    latencies = np.max(selected_saccade_times,0) if np.size(selected_saccade_times) \
+                else np.zeros(np.shape(saccade_times)[1])
+    
+    # exclude time 0 saccades -- out of range or nan
+    return np.where(latencies > 0,latencies,np.nan)
+    
+def turn_magnitudes(lmr_traces, baseline_win, turn_win, cutoff=30):
+    #lmr_traces = (n_samples x n_trs). max absolute, baseline subtracted and 
+    #low-pass filtered l-r change within turn_win for each trial
+    lmr_baseline_mean = np.nanmean(lmr_traces[baseline_win,:],0)
+    delta_lmr_traces = lmr_traces[turn_win,:] - lmr_baseline_mean
+    
+    # filter, take the absolute value for each trial (all trials in one call)
+    filtered_delta_lmr_traces = np.abs(butter_lowpass_filter(delta_lmr_traces,cutoff,axis=0))
+    
+    # now find the max displacement during the saccade window for each trace
+    return np.max(filtered_delta_lmr_traces,0)
+    
+def windowed_means(traces, win_starts, win_len):
+    #nan-ignoring mean of traces (n_samples x n_trs) over win_len samples from
+    #each start, for all windows and trials at once -> (n_windows x n_trs).
+    #uses cumulative sums, so the cost does not grow with win_len
+    traces = np.asarray(traces,dtype=float)
+    is_valid = ~np.isnan(traces)
+    n_samples = np.shape(traces)[0]
+    
+    sums = np.vstack((np.zeros(np.shape(traces)[1]),np.cumsum(np.where(is_valid,traces,0),0)))
+    counts = np.vstack((np.zeros(np.shape(traces)[1]),np.cumsum(is_valid,0)))
+    
+    win_starts = np.clip(np.asarray(win_starts,dtype=int),0,n_samples)
+    win_stops = np.clip(win_starts + win_len,0,n_samples)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return (sums[win_stops] - sums[win_starts])/(counts[win_stops] - counts[win_starts])
+    
+def windowed_delta_vm(vm_traces, baseline_win, max_t, step_size=1000, step_win=2000):
+    #mean vm in windows of step_win samples every step_size samples up to max_t,
+    #minus each trial's mean vm in baseline_win -> window starts, (n_windows x n_trs)
+    vm_traces = np.asarray(vm_traces,dtype=float)
+    with np.errstate(invalid='ignore'):
+        vm_baseline = np.nanmean(vm_traces[baseline_win,:],0)
+    t_starts = np.arange(0,max_t,step_size)
+    return t_starts, windowed_means(vm_traces,t_starts,step_win) - vm_baseline
+    
+def paired_corr(x, y):
+    #pearson r along the last axis of x and y (broadcast against each other), 
+    #using the positions where both are defined. returns r, n
+    x, y = np.broadcast_arrays(np.asarray(x,dtype=float),np.asarray(y,dtype=float))
+    is_valid = ~np.isnan(x) & ~np.isnan(y)
+    n = np.sum(is_valid,-1)
+    
+    with np.errstate(invalid='ignore',divide='ignore'):
+        x_mean = np.sum(np.where(is_valid,x,0),-1)/n
+        y_mean = np.sum(np.where(is_valid,y,0),-1)/n
+        x_c = np.where(is_valid,x - x_mean[...,np.newaxis],0)
+        y_c = np.where(is_valid,y - y_mean[...,np.newaxis],0)
+        
+        r = np.sum(x_c*y_c,-1)/np.sqrt(np.sum(x_c**2,-1)*np.sum(y_c**2,-1))
+    return np.clip(r,-1,1), n
+    
+def corr_r_p(x, y):
+    #pearson r and two-sided p of every row of x (n_windows x n_trs) against y
+    #(n_trs), using the trials where both are defined. same values as 
+    #sp.stats.pearsonr, for all windows at once. returns r, p, n per window
+    r, n = paired_corr(np.array(x,dtype=float,ndmin=2),y)
+    
+    with np.errstate(invalid='ignore',divide='ignore'):
+        df = n - 2
+        t_squared = r**2*(df/((1.0 - r)*(1.0 + r)))
+        p = sp.special.betainc(0.5*df,0.5,np.fmin(df/(df + t_squared),1.0))
+    p[(df < 1) | np.isnan(r)] = np.nan
+    p[np.abs(r) == 1] = 0
+    return r, p, n
+    
+def corr_matrix(x, ys):
+    #pearson r of every row of x (n_windows x n_trs) against every row of ys
+    #(n_ys x n_trs), over the trials where both are defined -> (n_windows x n_ys).
+    #all pairs come from a few matrix products
+    x = np.array(x,dtype=float,ndmin=2)
+    ys = np.array(ys,dtype=float,ndmin=2)
+    x_valid = (~np.isnan(x)).astype(float)
+    y_valid = (~np.isnan(ys)).astype(float)
+    
+    # center on each row's mean first so the raw moment sums stay well conditioned
+    with np.errstate(invalid='ignore',divide='ignore'):
+        x0 = np.nan_to_num(x - (np.nansum(x,1)/np.sum(x_valid,1))[:,np.newaxis])*x_valid
+        y0 = np.nan_to_num(ys - (np.nansum(ys,1)/np.sum(y_valid,1))[:,np.newaxis])*y_valid
+    
+    n = x_valid.dot(y_valid.T)
+    sum_x = x0.dot(y_valid.T)
+    sum_y = x_valid.dot(y0.T)
+    sum_xx = (x0**2).dot(y_valid.T)
+    sum_yy = x_valid.dot((y0**2).T)
+    sum_xy = x0.dot(y0.T)
+    
+    with np.errstate(invalid='ignore',divide='ignore'):
+        r = (n*sum_xy - sum_x*sum_y)/np.sqrt((n*sum_xx - sum_x**2)*(n*sum_yy - sum_y**2))
+    return np.clip(r,-1,1)
+    
+def corr_resample_chunk(task, x=None, y=None):
+    #one chunk of resampled correlations of the rows of x (n_windows x n_trs)
+    #with y (n_trs). task = (kind, seed, chunk index, n resamples). the random 
+    #state depends only on the task, so results do not depend on the number of workers
+    kind, seed, chunk_i, n_resamples = task
+    rand = np.random.RandomState([seed,int(kind == 'boot'),chunk_i])
+    n_trs = np.size(y)
+    
+    if kind == 'perm':
+        # shuffle y across trials -> max |r| over windows for each permutation
+        perm_is = np.argsort(rand.rand(n_resamples,n_trs),1)
+        return np.fmax.reduce(np.abs(corr_matrix(x,y[perm_is])),0)
+    else:
+        # resample trials with replacement -> (n_windows x n resamples) r
+        boot_is = rand.randint(0,n_trs,(n_resamples,n_trs))
+        return paired_corr(x[:,boot_is],y[boot_is])[0]
+    
+def corr_significance(x, y, n_perms=1000, n_boots=1000, alpha=.05, seed=0, 
+                      n_workers=1, chunk_size=250):
+    #permutation p values, corrected for the comparisons across windows with 
+    #the max statistic, and bootstrap confidence intervals for the correlation
+    #of each row of x (n_windows x n_trs) with y (n_trs). returns p_corr, r_lo, r_hi
+    x = np.array(x,dtype=float,ndmin=2)
+    y = np.asarray(y,dtype=float)
+    r = paired_corr(x,y)[0]
+    
+    tasks = [('perm',seed,chunk_i,stop-start) for chunk_i, (start, stop) in 
+                enumerate(chunk_bounds(n_perms,chunk_size)) if stop > start] + \
+            [('boot',seed,chunk_i,stop-start) for chunk_i, (start, stop) in 
+                enumerate(chunk_bounds(n_boots,chunk_size)) if stop > start]
+    chunk_func = functools.partial(corr_resample_chunk,x=x,y=y)
+    
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(min(n_workers,len(tasks)),1)
+    if n_workers == 1:
+        results = map(chunk_func,tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(chunk_func,tasks,chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    
+    max_rs = [result for task, result in zip(tasks,results) if task[0] == 'perm']
+    boot_rs = [result for task, result in zip(tasks,results) if task[0] == 'boot']
+    
+    p_corr = np.nan*np.ones(np.size(r))
+    if n_perms:
+        max_rs = np.hstack(max_rs)
+        # the observed labelling counts as one of the permutations
+        with np.errstate(invalid='ignore'):
+            n_exceed = np.sum(max_rs[np.newaxis,:] >= np.abs(r)[:,np.newaxis] - 1e-12,1)
+        p_corr = (1.0 + n_exceed)/(1.0 + n_perms)
+        p_corr[np.isnan(r)] = np.nan
+    
+    r_lo = np.nan*np.ones(np.size(r))
+    r_hi = np.nan*np.ones(np.size(r))
+    if n_boots:
+        boot_rs = np.hstack(boot_rs)
+        for w_i in range(np.size(r)):
+            this_boot_rs = boot_rs[w_i,~np.isnan(boot_rs[w_i,:])]
+            if np.size(this_boot_rs):
+                r_lo[w_i], r_hi[w_i] = np.percentile(this_boot_rs,[50*alpha,100-50*alpha])
+    return p_corr, r_lo, r_hi
+    
+def vm_behavior_corr(vm_traces, behavior, baseline_win, max_t, step_size=1000, step_win=2000,
+                     n_perms=0, n_boots=0, seed=0, n_workers=1):
+    #correlation of windowed, baseline subtracted vm with per-trial behavior 
+    #measures across trials. behavior = {measure name: (n_trs,) values, nan = no value}.
+    #returns a tidy data frame with one row per window and measure. with n_perms
+    #and n_boots, also the corrected permutation p (p_corr) and bootstrap 95% ci
+    t_starts, delta_vm = windowed_delta_vm(vm_traces,baseline_win,max_t,step_size,step_win)
+    
+    corr_dfs = []
+    for measure in sorted(behavior.keys()):
+        r, p, n = corr_r_p(delta_vm,behavior[measure])
+        p_corr, r_lo, r_hi = corr_significance(delta_vm,behavior[measure],n_perms,n_boots,
+                                               seed=seed,n_workers=n_workers)
+        corr_dfs.append(pd.DataFrame({'measure':measure,
+                                      't_start':t_starts,
+                                      't_stop':t_starts + step_win,
+                                      't_plot':t_starts + step_size/2.0,
+                                      'r':r,'p':p,'n':n,
+                                      'p_corr':p_corr,'r_lo':r_lo,'r_hi':r_hi},
+                                      columns=['measure','t_start','t_stop','t_plot','r','p','n',
+                                               'p_corr','r_lo','r_hi']))
+    return pd.concat(corr_dfs,ignore_index=True)
       
 def write_to_pdf(f_name,figures_list):
     from matplotlib.backends.backend_pdf import PdfPages
@@ -1068,32 +2255,136 @@ def write_to_pdf(f_name,figures_list):
         pp.savefig(f)
     pp.close()
 
-def plot_many_flies(path_name, filenames_df):    
+def plot_many_flies(path_name, filenames_df, out_dir=None, plot_names=['plot_wba_stim'],
+                    n_workers=None, rebuild=False, plot_kwargs={}):    
+    #save the figures of every fly of the catalog (see render_many_flies)
+    return render_many_flies(path_name,filenames_df,out_dir,plot_names,n_workers,rebuild,plot_kwargs)
 
-    #loop through all genotypes
-    genotypes = (pd.unique(filenames_df.values[:,1]))
-    print genotypes
+def render_fly_figures(render_task):
+    #worker for render_many_flies -- all figure types of one fly, drawn with
+    #the non-interactive agg backend. each figure type is saved into its own 
+    #temporary folder and then moved into out_dir. a marker file with the key
+    #of the recording, exclusions, protocol, figure type and its plot kwargs, 
+    #and the names of the saved figures, is written once they are moved. a 
+    #figure type whose key matches its marker and whose figures are all still
+    #there is skipped. returns (status, error text) per figure type. errors are 
+    #returned, not raised
+    fname, title_txt, ex_i, protocol, plot_names, out_dir, rebuild, plot_kwargs = render_task
     
-    for g in genotypes:
-        these_genotype_indicies = np.where(filenames_df.values[:,1] == g)[0]
+    old_backend = plt.get_backend()
+    fly = None #opened and processed for the first figure type that is drawn
+    results = []
+    try:
+        plt.switch_backend('agg')
+        for plot_name in plot_names:
+            try:
+                this_kwargs = plot_kwargs.get(plot_name,{})
+                abf_fname = Looming_Phys(fname).fname
+                marker_fname = os.path.join(out_dir,'.rendered',title_txt + '_' + plot_name + '.key')
+                render_key = stage_key(abf_source_key(abf_fname),plot_name,
+                                       [[list(x) for x in ex_i],protocol,sorted(this_kwargs.items())])
+                if not rebuild and os.path.exists(marker_fname):
+                    with open(marker_fname) as f:
+                        marker_lines = f.read().split('\n')
+                    if marker_lines[0] == render_key and len(marker_lines) > 1 and \
+                       all([os.path.exists(os.path.join(out_dir,x)) for x in marker_lines[1:]]):
+                        results.append(('skipped',None))
+                        continue
+                
+                if fly is None:
+                    fly = Looming_Phys(fname,protocol)
+                    fly.process_fly(ex_i)
+                if not os.path.exists(os.path.dirname(marker_fname)):
+                    os.makedirs(os.path.dirname(marker_fname))
+                plot_dir = tempfile.mkdtemp(prefix='rendering_',dir=os.path.dirname(marker_fname))
+                try:
+                    with profile_stage(plot_name,os.path.basename(abf_fname)):
+                        getattr(fly,plot_name)(title_txt,if_save=True,out_dir=plot_dir,**this_kwargs)
+                    figure_names = sorted(os.listdir(plot_dir))
+                    for figure_name in figure_names:
+                        os.rename(os.path.join(plot_dir,figure_name),os.path.join(out_dir,figure_name))
+                finally:
+                    shutil.rmtree(plot_dir,ignore_errors=True)
+                
+                with open(marker_fname + '.tmp','w') as f:
+                    f.write('\n'.join([render_key] + figure_names))
+                os.rename(marker_fname + '.tmp',marker_fname)
+                results.append(('rendered',None))
+            except Exception:
+                results.append(('failed',traceback.format_exc()))
+            finally:
+                plt.close('all')
+    finally:
+        if multiprocessing.current_process().name == 'MainProcess':
+            plt.switch_backend(old_backend) #n_workers=1 renders in the caller's process
+    return results
+
+@profiled
+def render_many_flies(path_name, filenames_df, out_dir=None, 
+                      plot_names=['plot_wba_stim','plot_vm_wba_stim','plot_vm_wba_stim_corr'],
+                      n_workers=None, rebuild=False, plot_kwargs={}):
+    #save the figures of every fly of the catalog into out_dir (figures_path 
+    #by default). plot_kwargs holds extra arguments per figure type, e.g.
+    #{'plot_vm_wba_stim_corr':{'n_perms':1000}}. flies are spread over worker 
+    #processes, and each fly's figure types are drawn by one worker, so a fly
+    #is processed once. figures whose recording, exclusions, type and 
+    #kwargs are unchanged are skipped. returns the status per fly and type
+    if out_dir is None:
+        out_dir = figures_path
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
     
-        for index in these_genotype_indicies:
-            print index
-        
-            fly = Looming_Behavior(path_name + filenames_df.values[index,0])
-            title_txt = filenames_df.values[index,1] + '  ' + filenames_df.values[index,0]
-            fly.process_fly()
-            fly.plot_wba_stim(title_txt)
-        
-            saveas_path = '/Users/jamie/bin/figures/'
-            plt.savefig(saveas_path + title_txt + '_kir_looming.png',dpi=100)
-            plt.close('all')
+    fly_tasks, fly_genotypes = pop_fly_tasks(path_name,filenames_df)
+    render_tasks = [(fname,g + '  ' + fly_name,ex_i,protocol,plot_names,out_dir,rebuild,plot_kwargs) 
+                    for (fname, fly_name, ex_i, protocol), g in zip(fly_tasks,fly_genotypes)]
+    render_results = map_flies(render_fly_figures,render_tasks,n_workers,'flies rendered')
+    
+    statuses = []
+    for render_task, fly_results in zip(render_tasks,render_results):
+        for plot_name, (status, error_txt) in zip(plot_names,fly_results):
+            if error_txt is not None:
+                print 'failed ' + render_task[1] + ' ' + plot_name + ' :\n' + error_txt
+            statuses.append(status)
+    return statuses
                     
-def get_pop_traces_df(path_name, population_f_names):  
-    #loop through all genotypes
-    #structure row = time points, aligned to looming start
-    #columns: genotype, fly, trial index, trial typa, lwa/rwa
-    #just collect these for all flies
+@profiled
+def map_flies(fly_func, fly_tasks, n_workers=None, progress_txt='flies'):
+    #run fly_func on each task in a process pool. results come back in task 
+    #order, whatever order the workers finish in. n_workers=1 runs in this process.
+    #while profiling, the workers' stage records are collected here
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(min(n_workers,len(fly_tasks)),1)
+    
+    t0 = time.time()
+    results = []
+    if_profile = n_workers > 1 and profile_records is not None
+    if n_workers == 1:
+        result_iter = (fly_func(task) for task in fly_tasks)
+    elif if_profile:
+        pool = multiprocessing.Pool(n_workers)
+        result_iter = pool.imap(profiled_fly_call,[(fly_func,task) for task in fly_tasks],chunksize=1)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        result_iter = pool.imap(fly_func,fly_tasks,chunksize=1)
+    
+    try:
+        for result in result_iter:
+            if if_profile:
+                result, worker_records = result
+                profile_records.extend(worker_records)
+            results.append(result)
+            print str(len(results)) + '/' + str(len(fly_tasks)) + ' ' + progress_txt + \
+                  ' (' + str(round(time.time()-t0,1)) + ' s)'
+    finally:
+        if n_workers > 1:
+            pool.close()
+            pool.join()
+    return results
+
+def pop_fly_tasks(path_name, population_f_names):
+    #(abf path, fly name, exclusion intervals, protocol) and genotype for every
+    #fly of the catalog, grouped by sorted genotype
     
     #genotypes must be sorted to the labels for columns 
     genotypes = (pd.unique(population_f_names.values[:,1]))
@@ -1101,47 +2392,533 @@ def get_pop_traces_df(path_name, population_f_names):
     genotypes = genotypes[1:]
     print genotypes
     
-    population_df = pd.DataFrame()
-    
-    #loop through each genotype  
+    fly_tasks = []
+    fly_genotypes = []
     for g in genotypes:
-        g
         these_genotype_indicies = np.where(population_f_names.values[:,1] == g)[0]
-    
-        for index in these_genotype_indicies:
-            print index
         
-            fly = Looming_Behavior(path_name + population_f_names.values[index,0])
-            fly.process_fly()
-            fly_df = fly.get_traces_by_stim(g)
-            population_df = pd.concat([population_df,fly_df],axis=1)
+        for index in these_genotype_indicies:
+            fly_name = population_f_names.values[index,0]
+            ex_i = catalog_exclusions(population_f_names.iloc[index])
+            protocol = catalog_protocol(population_f_names.iloc[index])
+            fly_tasks.append((path_name + fly_name,fly_name,ex_i,protocol))
+            fly_genotypes.append(g)
+    return fly_tasks, fly_genotypes
+
+def process_pop_fly(fly_task):
+    #worker for get_pop_traces_df. errors are returned, not raised, so one 
+    #corrupt recording does not stop the rest of the population
+    fname, fly_name, ex_i, protocol = fly_task
+    try:
+        with profile_stage('process_pop_fly',os.path.basename(fname)):
+            fly = Looming_Phys(fname,protocol)
+            fly.process_fly(ex_i)
+            return fly.get_traces_by_stim(fly_name), None
+    except Exception:
+        return None, traceback.format_exc()
+                    
+@profiled
+def get_pop_traces_df(path_name, population_f_names, n_workers=None):  
+    #loop through all genotypes
+    #structure row = time points, aligned to looming start
+    #columns: genotype, fly, trial index, trial typa, lwa/rwa
+    #just collect these for all flies
+    #flies are processed in parallel (see map_flies) and merged in catalog order
+    
+    fly_tasks, fly_genotypes = pop_fly_tasks(path_name,population_f_names)
+    fly_results = map_flies(process_pop_fly,fly_tasks,n_workers)
+    
+    all_fly_dfs = []
+    for (fname, fly_name, ex_i, protocol), g, (fly_df, error_txt) in zip(fly_tasks,fly_genotypes,fly_results):
+        if error_txt is not None:
+            print 'skipped ' + fname + ' :\n' + error_txt
+            continue
+        all_fly_dfs.append(pd.concat([fly_df],axis=1,keys=[g],names=['genotype']))
+    
+    if not all_fly_dfs:
+        return pd.DataFrame()
+    population_df = pd.concat(all_fly_dfs,axis=1)
     return population_df
      
-def plot_pop_flight_behavior_histograms(population_df, wba_lim=[-3,3],cnds_to_plot=range(9)):  
+class Population_Store():
+    #per-trial traces of a population, kept on disk instead of in one wide 
+    #data frame. each fly is one chunk -- a .npy array (n_traces x n_trs x n_samples)
+    #plus a small index with one row per (trial, trace): genotype, fly, tr_i, 
+    #tr_type, trace. new flies add new chunks, existing ones are never rewritten,
+    #and a query only reads the trace rows it selects. each fly is stored at one
+    #rate (see build_pop_store); queries over flies of different rates are refused
+    
+    index_columns = ['genotype','fly','tr_i','tr_type','trace','trace_i','row','rate']
+    
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.load_index()
+        
+    def load_index(self):
+        index_parts = [pd.read_pickle(f) for f in 
+                       sorted(glob.glob(os.path.join(self.store_dir,'*_index.pkl')))]
+        if index_parts:
+            self.index = pd.concat(index_parts,ignore_index=True)
+        else:
+            self.index = pd.DataFrame(columns=self.index_columns)
+        self.chunks = {}
+        
+    def fly_key(self, fly_name):
+        return str(fly_name).replace(os.sep,'_')
+        
+    def has_fly(self, fly_name, rate=None):
+        if rate is None:
+            return os.path.exists(os.path.join(self.store_dir,self.fly_key(fly_name) + '_index.pkl'))
+        return np.any((self.index['fly'] == fly_name).values & (self.index['rate'] == rate).values)
+        
+    def add_fly(self, genotype, fly_name, trial_traces, trial_info, trace_names, rate=10000):
+        #trial_traces, trial_info as returned by Looming_Phys.get_trial_tensor
+        key = self.fly_key(fly_name)
+        n_trs = np.shape(trial_traces)[0]
+        n_traces = len(trace_names)
+        
+        chunk = np.ascontiguousarray(np.transpose(trial_traces,(2,0,1)),dtype=np.float32)
+        np.save(os.path.join(self.store_dir,key + '.npy'),chunk)
+        
+        fly_index = pd.DataFrame({'genotype':genotype,
+                                  'fly':fly_name,
+                                  'tr_i':np.repeat(trial_info['tr_i'].values,n_traces),
+                                  'tr_type':np.repeat(trial_info['tr_type'].values,n_traces),
+                                  'trace':list(trace_names)*n_trs,
+                                  'trace_i':np.tile(np.arange(n_traces),n_trs),
+                                  'row':np.repeat(np.arange(n_trs),n_traces),
+                                  'rate':rate},
+                                  columns=self.index_columns)
+        write_pickle_atomically(os.path.join(self.store_dir,key + '_index.pkl'),fly_index)
+        
+        other_flies = self.index[self.index['fly'] != fly_name]
+        if len(other_flies):
+            self.index = pd.concat([other_flies,fly_index],ignore_index=True)
+        else:
+            self.index = fly_index #keeps integer columns, unlike a concat with the empty index
+        self.chunks.pop(key,None)
+        
+    def rate(self, selected=None):
+        #the one sampling rate of the selected index rows (all rows by default)
+        if selected is None:
+            selected = self.index
+        rates = np.unique(selected['rate'].values)
+        if np.size(rates) > 1:
+            raise ValueError('traces at several rates (' + ', '.join([str(int(r)) for r in rates]) + 
+                             ' hz) in ' + self.store_dir + ' -- rebuild the store at one rate')
+        if not np.size(rates):
+            return 10000
+        return int(rates[0])
+        
+    def genotypes(self):
+        return np.unique(self.index['genotype'].values)
+        
+    def flies(self, genotype):
+        return np.unique(self.index.loc[self.index['genotype'] == genotype,'fly'].values)
+        
+    def select(self, genotype=None, fly=None, tr_type=None, trace=None):
+        #index rows matching the query. None matches everything, lists match any
+        keep = np.ones(len(self.index),dtype=bool)
+        for column, value in zip(['genotype','fly','tr_type','trace'],[genotype,fly,tr_type,trace]):
+            if value is None:
+                continue
+            if np.ndim(value):
+                keep &= self.index[column].isin(value).values
+            else:
+                keep &= (self.index[column] == value).values
+        return self.index[keep]
+        
+    def get_chunk(self, fly_name):
+        key = self.fly_key(fly_name)
+        if key not in self.chunks:
+            self.chunks[key] = np.load(os.path.join(self.store_dir,key + '.npy'),mmap_mode='r')
+        return self.chunks[key]
+        
+    def read_rows(self, selected):
+        #(n_samples x n_selected) array of the selected index rows, read fly by 
+        #fly from the memory mapped chunks. flies with shorter trials are nan padded
+        self.rate(selected) #samples of different rates can not share rows
+        fly_traces = []
+        for fly_name in pd.unique(selected['fly'].values):
+            fly_rows = selected[selected['fly'].values == fly_name]
+            chunk = self.get_chunk(fly_name)
+            fly_traces.append(chunk[fly_rows['trace_i'].values,fly_rows['row'].values,:])
+        
+        n_samples = max([np.shape(x)[1] for x in fly_traces] + [0])
+        traces = np.empty((n_samples,len(selected)))
+        traces.fill(np.nan)
+        col_i = 0
+        for x in fly_traces:
+            traces[:np.shape(x)[1],col_i:col_i+np.shape(x)[0]] = x.T
+            col_i = col_i + np.shape(x)[0]
+        return traces
+        
+    def get_traces(self, genotype=None, fly=None, tr_type=None, trace='lmr'):
+        #like .as_matrix() on the matching columns of the population data frame
+        return self.read_rows(self.select(genotype,fly,tr_type,trace))
+        
+    def to_df(self, genotype=None, fly=None, tr_type=None, trace=None):
+        #the selected traces as a five column-level population data frame
+        selected = self.select(genotype,fly,tr_type,trace)
+        column_labels = pd.MultiIndex.from_arrays([selected[c].values for c in 
+                                                   ['genotype','fly','tr_i','tr_type','trace']],
+                                                   names=['genotype','fly','tr_i','tr_type','trace'])
+        return pd.DataFrame(self.read_rows(selected),columns=column_labels)
+
+def process_pop_fly_tensor(fly_task, rate=10000):
+    #worker for build_pop_store. like process_pop_fly, but returns the compact
+    #trial tensor and trial table instead of a data frame
+    fname, fly_name, ex_i, protocol = fly_task
+    trace_names = ['lmr','lwa','rwa','vm','ystim']
+    try:
+        with profile_stage('process_pop_fly_tensor',os.path.basename(fname)):
+            fly = Looming_Phys(fname,protocol)
+            fly.process_fly(ex_i)
+            trial_traces, trial_info = fly.get_trial_tensor(trace_names=trace_names,rate=rate)
+            return (trial_traces.astype(np.float32),trial_info,trace_names), None
+    except Exception:
+        return None, traceback.format_exc()
+        
+@profiled
+def build_pop_store(path_name, population_f_names, store_dir, n_workers=None, rebuild=False,
+                    rate=10000):
+    #incremental version of get_pop_traces_df. only flies that are not in the 
+    #store yet (at this rate) are processed, and each is written as its own chunk.
+    #a decimated rate (see Phys_Flight.get_channel) shrinks the store 10-100x
+    store = Population_Store(store_dir)
+    fly_tasks, fly_genotypes = pop_fly_tasks(path_name,population_f_names)
+    
+    new_tasks = []
+    new_genotypes = []
+    for task, g in zip(fly_tasks,fly_genotypes):
+        if rebuild or not store.has_fly(task[1],rate):
+            new_tasks.append(task)
+            new_genotypes.append(g)
+    print str(len(fly_tasks)-len(new_tasks)) + ' flies already stored'
+    
+    if new_tasks:
+        fly_results = map_flies(functools.partial(process_pop_fly_tensor,rate=rate),new_tasks,n_workers)
+        for (fname, fly_name, ex_i, protocol), g, (fly_result, error_txt) in zip(new_tasks,new_genotypes,fly_results):
+            if error_txt is not None:
+                print 'skipped ' + fname + ' :\n' + error_txt
+                continue
+            trial_traces, trial_info, trace_names = fly_result
+            store.add_fly(g,fly_name,trial_traces,trial_info,trace_names,rate)
+    return store
+    
+def pop_genotypes(population):
+    #population is a Population_Store or a population data frame
+    if isinstance(population,Population_Store):
+        return population.genotypes()
+    return np.unique(population.columns.get_level_values(0))
+    
+def pop_flies(population, g):
+    if isinstance(population,Population_Store):
+        return population.flies(g)
+    return np.unique(population.loc[:,(g)].columns.get_level_values(0))
+    
+def pop_rate(population):
+    #sampling rate of the population traces. the population windows (baselines, 
+    #plot limits) are written in 10 khz samples -- see rate_samples
+    if isinstance(population,Population_Store) or isinstance(population,Summary_Cube):
+        return population.rate()
+    return 10000
+    
+def rate_samples(samples, rate):
+    #10 khz sample indices at rate
+    return [int(x)*int(rate)//10000 for x in samples]
+    
+def pop_traces(population, g, fly_name, cnd, trace):
+    #(n_samples x n_trs) traces of one genotype/condition -- all flies if fly_name is None 
+    if isinstance(population,Population_Store):
+        return population.get_traces(g,fly_name,cnd,trace)
+    if fly_name is None:
+        fly_name = slice(None)
+    return population.loc[:,(g,fly_name,slice(None),cnd,trace)].values
+    
+def pop_fly_trials(population, g, fly_name, trace_names):
+    #all trials of one fly -- trial types (n_trs,) and traces (n_traces x n_trs x n_samples)
+    if isinstance(population,Population_Store):
+        chunk = population.get_chunk(fly_name)
+        traces = []
+        for trace in trace_names:
+            rows = population.select(g,fly_name,None,trace).sort_values('row')
+            traces.append(chunk[rows['trace_i'].values,rows['row'].values,:])
+        return rows['tr_type'].values.astype(int), np.array(traces,dtype=float)
+    
+    fly_df = population.loc[:,(g,fly_name)]
+    traces = []
+    for trace in trace_names:
+        trace_df = fly_df.xs(trace,axis=1,level='trace')
+        traces.append(trace_df.values.T)
+    return trace_df.columns.get_level_values('tr_type').values.astype(int), np.array(traces,dtype=float)
+    
+class Summary_Cube():
+    #per-fly and per-genotype trial statistics of a population: mean, sem and 
+    #n over trials for each condition, channel and sample, baseline subtracted.
+    #built in one pass over the flies (see build_summary_cube), so the population
+    #plots never go back to the full traces. fly_* arrays are (n_flies x n_cnds x
+    #n_channels x n_samples), g_* arrays (n_genotypes x ...), all float32, 
+    #sampled at sample_rate
+    
+    array_names = ['fly_mean','fly_sem','fly_n','g_mean','g_sem','g_n']
+    
+    def __init__(self, genotypes, fly_genotypes, fly_names, cnds, channels, arrays, sample_rate=10000):
+        self.sample_rate = int(sample_rate)
+        self.genotypes = list(genotypes)
+        self.fly_genotypes = list(fly_genotypes)
+        self.fly_names = list(fly_names)
+        self.cnds = list(cnds)
+        self.channels = list(channels)
+        for name in self.array_names:
+            setattr(self,name,arrays[name])
+            
+    def rate(self):
+        return self.sample_rate
+        
+    def flies(self, g):
+        return [fly_name for fly_g, fly_name in zip(self.fly_genotypes,self.fly_names) if fly_g == g]
+        
+    def fly_stat(self, stat, g, fly_name, cnd, channel):
+        #(n_samples,) mean, sem or n of one fly
+        fly_i = zip(self.fly_genotypes,self.fly_names).index((g,fly_name))
+        return getattr(self,'fly_' + stat)[fly_i,self.cnds.index(cnd),self.channels.index(channel)]
+        
+    def g_stat(self, stat, g, cnd, channel):
+        #(n_samples,) mean, sem or n of all trials of a genotype
+        return getattr(self,'g_' + stat)[self.genotypes.index(g),self.cnds.index(cnd),
+                                         self.channels.index(channel)]
+        
+    def save(self, fname):
+        np.savez(fname,genotypes=self.genotypes,fly_genotypes=self.fly_genotypes,
+                 fly_names=self.fly_names,cnds=self.cnds,channels=self.channels,
+                 sample_rate=self.sample_rate,**dict([(name,getattr(self,name)) for name in self.array_names]))
+                 
+def load_summary_cube(fname):
+    cube_file = np.load(fname)
+    sample_rate = int(cube_file['sample_rate']) if 'sample_rate' in cube_file.files else 10000
+    return Summary_Cube(cube_file['genotypes'].tolist(),cube_file['fly_genotypes'].tolist(),
+                        cube_file['fly_names'].tolist(),cube_file['cnds'].tolist(),
+                        cube_file['channels'].tolist(),cube_file,sample_rate)
+                        
+def trial_group_stats(traces, tr_types, cnds):
+    #sum, sum of squares and n over the trials of each condition, ignoring nans.
+    #traces = (n_channels x n_trs x n_samples) -> three (n_cnds x n_channels x n_samples)
+    #arrays, from one sort of the trials and np.add.reduceat over the groups
+    n_channels, n_trs, n_samples = np.shape(traces)
+    stats = np.zeros((3,len(cnds),n_channels,n_samples))
+    
+    order = np.argsort(tr_types,kind='mergesort')
+    sorted_types = np.asarray(tr_types)[order]
+    group_starts = np.where(np.hstack((True,sorted_types[1:] != sorted_types[:-1])))[0] \
+                   if n_trs else np.array([],dtype=int)
+    if not np.size(group_starts):
+        return stats
+    
+    sorted_traces = traces[:,order,:]
+    is_valid = ~np.isnan(sorted_traces)
+    values = np.where(is_valid,sorted_traces,0)
+    group_sums = [np.add.reduceat(x,group_starts,axis=1) for x in [values,values**2,is_valid]]
+    
+    for group_i, tr_type in enumerate(sorted_types[group_starts]):
+        if tr_type in cnds:
+            for stat_i in range(3):
+                stats[stat_i,cnds.index(tr_type)] = group_sums[stat_i][:,group_i,:]
+    return stats
+    
+def mean_sem_from_sums(sums, sum_squares, n):
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = sums/n
+        var = (sum_squares - n*mean**2)/(n - 1)
+        sem = np.sqrt(np.maximum(var,0)/n)
+    return mean.astype(np.float32), sem.astype(np.float32), n.astype(np.float32)
+    
+@profiled
+def build_summary_cube(population, genotypes=None, cnds=range(9), baseline_win=[200,700],
+                       channels=['lmr','lwa','rwa','vm','ystim'],
+                       baseline_channels=['lmr','lwa','rwa','vm']):
+    #one pass over the flies of a population data frame or Population_Store.
+    #each trial of baseline_channels has its mean over baseline_win (10 khz 
+    #samples, converted to the population's rate) subtracted.
+    #lmr is taken as lwa - rwa, like the population plots always did (the stored
+    #lmr trace is the cleaned signal). genotype stats pool the trials of its flies
+    if genotypes is None:
+        genotypes = pop_genotypes(population)
+    cnds = list(cnds)
+    rate = pop_rate(population)
+    baseline_win = rate_samples(baseline_win,rate)
+    trace_names = [ch for ch in channels if ch != 'lmr'] + ['lwa','rwa']
+    trace_names = sorted(set(trace_names),key=trace_names.index)
+    
+    fly_genotypes = []
+    fly_names = []
+    fly_stats = []
+    for g in genotypes:
+        for fly_name in pop_flies(population,g):
+            with profile_stage('fly_stats',fly_name):
+                tr_types, traces = pop_fly_trials(population,g,fly_name,trace_names)
+                traces = np.array([traces[trace_names.index('lwa')] - traces[trace_names.index('rwa')] 
+                                   if ch == 'lmr' else traces[trace_names.index(ch)] for ch in channels])
+                
+                for ch_i, ch in enumerate(channels):
+                    if ch in baseline_channels:
+                        baseline_traces = traces[ch_i,:,baseline_win[0]:baseline_win[1]]
+                        is_valid = ~np.isnan(baseline_traces)
+                        with np.errstate(invalid='ignore',divide='ignore'):
+                            baseline = np.sum(np.where(is_valid,baseline_traces,0),1)/np.sum(is_valid,1)
+                        traces[ch_i] = traces[ch_i] - baseline[:,np.newaxis]
+                
+                fly_genotypes.append(g)
+                fly_names.append(fly_name)
+                fly_stats.append(trial_group_stats(traces,tr_types,cnds))
+    
+    #pad the flies to the longest trials. missing samples have n = 0
+    n_samples = max([np.shape(x)[-1] for x in fly_stats] + [0])
+    all_stats = np.zeros((3,len(fly_stats),len(cnds),len(channels),n_samples))
+    for fly_i, stats in enumerate(fly_stats):
+        all_stats[:,fly_i,:,:,:np.shape(stats)[-1]] = stats
+        
+    g_stats = np.zeros((3,len(genotypes),len(cnds),len(channels),n_samples))
+    for g_i, g in enumerate(genotypes):
+        g_stats[:,g_i] = np.sum(all_stats[:,np.asarray(fly_genotypes) == g],1)
+    
+    arrays = {}
+    arrays['fly_mean'], arrays['fly_sem'], arrays['fly_n'] = mean_sem_from_sums(*all_stats)
+    arrays['g_mean'], arrays['g_sem'], arrays['g_n'] = mean_sem_from_sums(*g_stats)
+    return Summary_Cube(genotypes,fly_genotypes,fly_names,cnds,channels,arrays,rate)
+    
+class Hist2d_Accumulator():
+    #fixed-bin 2d histogram of (time, amplitude) samples that is filled one fly
+    #or chunk of trials at a time, so memory does not grow with the number of 
+    #trials. bins are found with integer arithmetic and counted with bincount;
+    #counts are integers, so accumulators from different workers merge exactly
+    
+    def __init__(self, n_t_bins=200, n_y_bins=50, t_range=[0,4200], y_range=[-3,3]):
+        self.n_t_bins = n_t_bins
+        self.n_y_bins = n_y_bins
+        self.t_range = [int(t_range[0]),int(t_range[1])]
+        self.y_range = [float(y_range[0]),float(y_range[1])]
+        self.counts = np.zeros((n_t_bins,n_y_bins),dtype=np.int64)
+        
+    def add_traces(self, traces, t_start=0, chunk_trs=64):
+        #traces = (n_samples x n_trs), sample i of each trial at time t_start + i.
+        #nans and samples outside the ranges are not counted
+        traces = np.asarray(traces)
+        n_samples = np.shape(traces)[0]
+        t = np.arange(t_start,t_start + n_samples)
+        t_span = self.t_range[1] - self.t_range[0]
+        t_bins = ((t - self.t_range[0])*self.n_t_bins)//t_span
+        t_bins[t == self.t_range[1]] = self.n_t_bins - 1 #right edge is in the last bin
+        t_ok = (t >= self.t_range[0]) & (t <= self.t_range[1])
+        t_bins = t_bins[t_ok]
+        
+        y_scale = self.n_y_bins/(self.y_range[1] - self.y_range[0])
+        for tr_start in range(0,np.shape(traces)[1],chunk_trs):
+            y = np.asarray(traces[t_ok,tr_start:tr_start+chunk_trs],dtype=float)
+            with np.errstate(invalid='ignore'):
+                y_ok = (y >= self.y_range[0]) & (y <= self.y_range[1])
+            y_bins = np.minimum(((y[y_ok] - self.y_range[0])*y_scale).astype(np.int64),self.n_y_bins - 1)
+            bins = np.broadcast_to(t_bins[:,np.newaxis],np.shape(y))[y_ok]*self.n_y_bins + y_bins
+            self.counts += np.bincount(bins,minlength=self.n_t_bins*self.n_y_bins).reshape(
+                                np.shape(self.counts))
+        return self
+        
+    def merge(self, other):
+        if [self.n_t_bins,self.n_y_bins,self.t_range,self.y_range] != \
+           [other.n_t_bins,other.n_y_bins,other.t_range,other.y_range]:
+            raise ValueError('can not merge histograms with different bins')
+        self.counts += other.counts
+        return self
+        
+    def edges(self):
+        return np.linspace(self.t_range[0],self.t_range[1],self.n_t_bins + 1), \
+               np.linspace(self.y_range[0],self.y_range[1],self.n_y_bins + 1)
+               
+    def density(self):
+        #like np.histogram2d(..., normed=True)
+        t_edges, y_edges = self.edges()
+        bin_area = np.diff(t_edges)[:,np.newaxis]*np.diff(y_edges)[np.newaxis,:]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.counts/(bin_area*np.sum(self.counts))
+            
+lmr_hist_t_range = [0,4200] #10 khz samples of the population lmr histograms
+
+def fly_lmr_histograms(population, g, fly_name, cnds, baseline_win=[200,700], t_range=lmr_hist_t_range,
+                       **hist_kwargs):
+    #per-condition Hist2d_Accumulators of one fly's baseline subtracted lwa - rwa.
+    #baseline_win and t_range are 10 khz samples, converted to the population's rate
+    rate = pop_rate(population)
+    baseline_win = rate_samples(baseline_win,rate)
+    hist_kwargs['t_range'] = rate_samples(t_range,rate)
+    with profile_stage('fly_lmr_histograms',fly_name):
+        tr_types, traces = pop_fly_trials(population,g,fly_name,['lwa','rwa'])
+        lmr = traces[0] - traces[1]
+        with np.errstate(invalid='ignore'):
+            lmr = lmr - np.nanmean(lmr[:,baseline_win[0]:baseline_win[1]],1)[:,np.newaxis]
+        
+        fly_hists = {}
+        for cnd in cnds:
+            fly_hists[cnd] = Hist2d_Accumulator(**hist_kwargs).add_traces(lmr[tr_types == cnd,:].T)
+        return fly_hists
+    
+def store_fly_lmr_histograms(fly_task, cnds=range(9)):
+    #worker for pop_lmr_histograms -- fly_task = (store dir, genotype, fly name)
+    store_dir, g, fly_name = fly_task
+    return fly_lmr_histograms(Population_Store(store_dir),g,fly_name,cnds)
+    
+@profiled
+def pop_lmr_histograms(population, g, cnds=range(9), n_workers=1):
+    #per-condition histograms of all trials of a genotype, accumulated one fly 
+    #at a time. flies of a Population_Store can be spread over worker processes
+    fly_names = pop_flies(population,g)
+    if isinstance(population,Population_Store) and n_workers != 1:
+        fly_tasks = [(population.store_dir,g,fly_name) for fly_name in fly_names]
+        fly_hists_iter = map_flies(functools.partial(store_fly_lmr_histograms,cnds=cnds),
+                                   fly_tasks,n_workers,'fly histograms')
+    else:
+        fly_hists_iter = (fly_lmr_histograms(population,g,fly_name,cnds) for fly_name in fly_names)
+    
+    t_range = rate_samples(lmr_hist_t_range,pop_rate(population))
+    g_hists = dict([(cnd,Hist2d_Accumulator(t_range=t_range)) for cnd in cnds])
+    for fly_hists in fly_hists_iter:
+        for cnd in cnds:
+            g_hists[cnd].merge(fly_hists[cnd])
+    return g_hists
+    
+def summary_cube(population, genotypes=None):
+    #the population plots take a Summary_Cube, or build one from the population
+    if isinstance(population,Summary_Cube):
+        return population
+    return build_summary_cube(population,genotypes)
+    
+def plot_pop_flight_behavior_histograms(population_df, wba_lim=[-3,3],cnds_to_plot=range(9),n_workers=1,out_dir=None):  
     #for the looming data, plot histograms over time of all left-right
-    #wba traces
+    #wba traces. the histograms are accumulated fly by fly (see pop_lmr_histograms)
     
-    #instead send the population dataframe as a parameter
+    #instead send the population dataframe (or a Population_Store) as a parameter
     
     #get a two-dimensional multi-indexed data frame with the population data
     #population_df = get_pop_flight_traces(path_name, population_f_names)
    
     #loop through each genotype  --- genotypes must be sorted to be column labels
     #change code so I just do this in the get_pop_flight_traces
-    all_genotype_fields = population_df.columns.get_level_values(0)
-    genotypes = np.unique(all_genotype_fields)
+    genotypes = pop_genotypes(population_df)
     
-    x_lim = [0, 4075]
+    x_lim = rate_samples([0, 4075],pop_rate(population_df)) #10 khz samples at the population's rate
     
     for g in genotypes:
         print g
         
         #calculate the number of cells/genotype
-        all_cell_names = population_df.loc[:,(g)].columns.get_level_values(0)
-        n_cells = np.size(np.unique(all_cell_names))
+        unique_fly_names = pop_flies(population_df,g)
+        n_cells = np.size(unique_fly_names)
         
         title_txt = g + ' __ ' + str(n_cells) + ' flies' #also add number of flies and trials here 
         #calculate the number of flies and trials for the caption
+        
+        g_hists = pop_lmr_histograms(population_df,g,cnds_to_plot,n_workers)
     
         fig = plt.figure(figsize=(16.5, 9))
         #change this so I'm not hardcoding the number of axes
@@ -1155,34 +2932,9 @@ def plot_pop_flight_behavior_histograms(population_df, wba_lim=[-3,3],cnds_to_pl
             #plot WBA histogram signal -----------------------------------------------------------    
             wba_ax = plt.subplot(gs[grid_row,grid_col])     
         
-            g_lwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'lwa')].as_matrix()
-            g_rwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'rwa')].as_matrix()    
-            g_lmr = g_lwa - g_rwa
-        
-            #get baseline, substract from traces
-            baseline = np.nanmean(g_lmr[200:700,:],0) #parametize this
-            g_lmr = g_lmr - baseline
-        
-            #just plot the mean for debugging
-            #wba_ax.plot(np.nanmean(g_lmr,1))
-        
-            #now plot the histograms over time. ------------
-            max_t = np.shape(g_lmr)[0]
-            n_trs = np.shape(g_lmr)[1]
-                     
-            t_points = range(max_t)
-            t_matrix = np.tile(t_points,(n_trs,1))
-            t_matrix_t = np.transpose(t_matrix)
-
-            t_flat = t_matrix_t.flatten() 
-            g_lmr_flat = g_lmr.flatten()
-
-            #now remove nans
-            g_lmr_flat = g_lmr_flat[~np.isnan(g_lmr_flat)]
-            t_flat = t_flat[~np.isnan(g_lmr_flat)]
-
-            #calc, plot histogram
-            h2d, xedges, yedges = np.histogram2d(t_flat,g_lmr_flat,bins=[200,50],range=[[0, 4200],[-3,3]],normed=True)
+            #plot the histograms over time of the baseline subtracted traces. ------------
+            h2d = g_hists[cnd].density()
+            xedges, yedges = g_hists[cnd].edges()
             wba_ax.pcolormesh(xedges, yedges, np.transpose(h2d))
         
            
@@ -1202,8 +2954,8 @@ def plot_pop_flight_behavior_histograms(population_df, wba_lim=[-3,3],cnds_to_pl
             stim_ax = plt.subplot(gs[grid_row+1,grid_col])
         
             #assume the first trace of each is typical
-            y_stim = population_df.loc[:,(g,slice(None),slice(None),cnd,'ystim')]
-            stim_ax.plot(y_stim.iloc[:,0],color=blue)
+            y_stim = pop_traces(population_df,g,unique_fly_names[0],cnd,'ystim')
+            lod_plot(stim_ax,y_stim[:,0],color=blue,xlim=x_lim)
         
             stim_ax.set_xlim(x_lim) 
             stim_ax.set_ylim([0, 10]) 
@@ -1228,33 +2980,33 @@ def plot_pop_flight_behavior_histograms(population_df, wba_lim=[-3,3],cnds_to_pl
         fig.text(.425,.95,title_txt,fontsize=18)        
         plt.draw() 
 
-        saveas_path = '/Users/jamie/bin/figures/'
+        saveas_path = figure_dir(out_dir)
         plt.savefig(saveas_path + title_txt + '_population_kir_looming_histograms.png',dpi=100)
         #plt.close('all')
 
-def plot_pop_flight_behavior_means(population_df, wba_lim=[-3,3], cnds_to_plot=range(9)):  
+def plot_pop_flight_behavior_means(population_df, wba_lim=[-3,3], cnds_to_plot=range(9), out_dir=None):  
     #for the looming data, plot the means of all left-right
     #wba traces
     
-    #instead send the population dataframe as a parameter
+    #instead send the population dataframe, a Population_Store or a Summary_Cube 
+    #as a parameter. all means come from the summary cube
     
     #get a two-dimensional multi-indexed data frame with the population data
     #population_df = get_pop_flight_traces(path_name, population_f_names)
    
     #loop through each genotype  --- genotypes must be sorted to be column labels
     #change code so I just do this in the get_pop_flight_traces
-    all_genotype_fields = population_df.columns.get_level_values(0)
-    genotypes = np.unique(all_genotype_fields)
+    cube = summary_cube(population_df)
+    genotypes = cube.genotypes
     
-    x_lim = [0, 4075]
-    speed_x_lims = [range(0,2600),range(0,3115),range(0,4075)] #restrict the xlims by condition to not show erroneously long traces
+    x_lim = rate_samples([0, 4075],cube.rate()) #10 khz samples at the cube's rate
+    speed_x_lims = [range(*rate_samples([0,stop],cube.rate())) for stop in [2600,3115,4075]] #restrict the xlims by condition to not show erroneously long traces
     
     for g in genotypes:
         print g
         
         #calculate the number of cells/genotype
-        all_fly_names = population_df.loc[:,(g)].columns.get_level_values(0)
-        unique_fly_names = np.unique(all_fly_names)
+        unique_fly_names = cube.flies(g)
         n_cells = np.size(unique_fly_names)
         
         title_txt = g + ' __ ' + str(n_cells) + ' flies' #also add number of flies and trials here 
@@ -1273,29 +3025,14 @@ def plot_pop_flight_behavior_means(population_df, wba_lim=[-3,3], cnds_to_plot=r
             #make the axis --------------------------------
             wba_ax = plt.subplot(gs[grid_row,grid_col])     
         
-            #plot the mean of each fly --------------------------------
+            #plot the mean of each fly (baseline subtracted) --------------------------------
             for fly_name in unique_fly_names:
-                fly_lwa = population_df.loc[:,(g,fly_name,slice(None),cnd,'lwa')].as_matrix()
-                fly_rwa = population_df.loc[:,(g,fly_name,slice(None),cnd,'rwa')].as_matrix()    
-                fly_lmr = fly_lwa - fly_rwa
-        
-                #get baseline, substract from traces
-                baseline = np.nanmean(fly_lmr[200:700,:],0) #parametize this
-                fly_lmr = fly_lmr - baseline
-            
-                wba_ax.plot(np.nanmean(fly_lmr[this_x_lim,:],1),color=black,linewidth=.5)        
-        
+                fly_lmr_mean = cube.fly_stat('mean',g,fly_name,cnd,'lmr')
+                lod_plot(wba_ax,fly_lmr_mean[this_x_lim],color=black,linewidth=.5,xlim=x_lim)        
         
             #plot the genotype mean --------------------------------   
-            g_lwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'lwa')].as_matrix()
-            g_rwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'rwa')].as_matrix()    
-            g_lmr = g_lwa - g_rwa
-        
-            #get baseline, substract from traces
-            baseline = np.nanmean(g_lmr[200:700,:],0) #parametize this
-            g_lmr = g_lmr - baseline
-            
-            wba_ax.plot(np.nanmean(g_lmr[this_x_lim,:],1),color=magenta,linewidth=2)
+            g_lmr_mean = cube.g_stat('mean',g,cnd,'lmr')
+            lod_plot(wba_ax,g_lmr_mean[this_x_lim],color=magenta,linewidth=2,xlim=x_lim)
               
             #plot black line for 0 --------------------------------
             wba_ax.axhline(color=black)
@@ -1314,9 +3051,9 @@ def plot_pop_flight_behavior_means(population_df, wba_lim=[-3,3], cnds_to_plot=r
             #now plot stim -----------------------------------------------------------
             stim_ax = plt.subplot(gs[grid_row+1,grid_col])
         
-            #assume the first trace of each is typical
-            y_stim = population_df.loc[:,(g,slice(None),slice(None),cnd,'ystim')]
-            stim_ax.plot(y_stim.iloc[:,0],color=blue)
+            #the stimulus is the same on every trial of a condition -- plot the mean
+            y_stim = cube.g_stat('mean',g,cnd,'ystim')
+            lod_plot(stim_ax,y_stim,color=blue,xlim=x_lim)
         
             stim_ax.set_xlim(x_lim) 
             stim_ax.set_ylim([0, 10]) 
@@ -1341,26 +3078,25 @@ def plot_pop_flight_behavior_means(population_df, wba_lim=[-3,3], cnds_to_plot=r
         fig.text(.425,.95,title_txt,fontsize=18)        
         plt.draw() 
 
-        saveas_path = '/Users/jamie/bin/figures/'
+        saveas_path = figure_dir(out_dir)
         plt.savefig(saveas_path + title_txt + '_population_kir_looming_means.png',dpi=100)
         plt.close('all')
         
-def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim=[-3,3], cnds_to_plot=range(9)):  
+def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim=[-3,3], cnds_to_plot=range(9), out_dir=None):  
     #for the looming data, plot the means of all left-right
     #wba traces
     
-    #instead send the population dataframe as a parameter
+    #instead send the population dataframe (or a Population_Store) as a parameter
     
     #get a two-dimensional multi-indexed data frame with the population data
     #population_df = get_pop_flight_traces(path_name, population_f_names)
    
     #loop through each genotype  --- genotypes must be sorted to be column labels
     #change code so I just do this in the get_pop_flight_traces
-    all_genotype_fields = population_df.columns.get_level_values(0)
-    genotypes = np.unique(all_genotype_fields)
+    cube = summary_cube(population_df,two_genotypes) #only the two genotypes are summarized
     
-    x_lim = [0, 4075]
-    speed_x_lims = [range(0,2600),range(0,3115),range(0,4075)] #restrict the xlims by condition to not show erroneously long traces
+    x_lim = rate_samples([0, 4075],cube.rate()) #10 khz samples at the cube's rate
+    speed_x_lims = [range(*rate_samples([0,stop],cube.rate())) for stop in [2600,3115,4075]] #restrict the xlims by condition to not show erroneously long traces
     
     fig = plt.figure(figsize=(16.5, 9))
     #change this so I'm not hardcoding the number of axes
@@ -1374,8 +3110,7 @@ def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim
         print g
         
         #calculate the number of cells/genotype
-        all_fly_names = population_df.loc[:,(g)].columns.get_level_values(0)
-        unique_fly_names = np.unique(all_fly_names)
+        unique_fly_names = cube.flies(g)
         n_cells = np.size(unique_fly_names)
         
         title_txt = title_txt + g + ' __ ' + str(n_cells) + ' flies ' #also add number of flies and trials here 
@@ -1390,28 +3125,14 @@ def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim
             #make the axis --------------------------------
             wba_ax = plt.subplot(gs[grid_row,grid_col])     
         
-            #plot the mean of each fly --------------------------------
+            #plot the mean of each fly (baseline subtracted) --------------------------------
             for fly_name in unique_fly_names:
-                fly_lwa = population_df.loc[:,(g,fly_name,slice(None),cnd,'lwa')].as_matrix()
-                fly_rwa = population_df.loc[:,(g,fly_name,slice(None),cnd,'rwa')].as_matrix()    
-                fly_lmr = fly_lwa - fly_rwa
-        
-                #get baseline, substract from traces
-                baseline = np.nanmean(fly_lmr[200:700,:],0) #parametize this
-                fly_lmr = fly_lmr - baseline
-            
-                wba_ax.plot(np.nanmean(fly_lmr[this_x_lim,:],1),color=genotype_colors[i],linewidth=.25)        
+                fly_lmr_mean = cube.fly_stat('mean',g,fly_name,cnd,'lmr')
+                lod_plot(wba_ax,fly_lmr_mean[this_x_lim],color=genotype_colors[i],linewidth=.25,xlim=x_lim)        
         
             #plot the genotype mean --------------------------------   
-            g_lwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'lwa')].as_matrix()
-            g_rwa = population_df.loc[:,(g,slice(None),slice(None),cnd,'rwa')].as_matrix()    
-            g_lmr = g_lwa - g_rwa
-        
-            #get baseline, substract from traces
-            baseline = np.nanmean(g_lmr[200:700,:],0) #parametize this
-            g_lmr = g_lmr - baseline
-            
-            wba_ax.plot(np.nanmean(g_lmr[this_x_lim,:],1),color=genotype_colors[i],linewidth=2)
+            g_lmr_mean = cube.g_stat('mean',g,cnd,'lmr')
+            lod_plot(wba_ax,g_lmr_mean[this_x_lim],color=genotype_colors[i],linewidth=2,xlim=x_lim)
               
             #plot black line for 0 --------------------------------
             wba_ax.axhline(color=black)
@@ -1430,9 +3151,9 @@ def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim
             #now plot stim -----------------------------------------------------------
             stim_ax = plt.subplot(gs[grid_row+1,grid_col])
 
-            #assume the first trace of each is typical
-            y_stim = population_df.loc[:,(g,slice(None),slice(None),cnd,'ystim')]
-            stim_ax.plot(y_stim.iloc[:,0],color=black)
+            #the stimulus is the same on every trial of a condition -- plot the mean
+            y_stim = cube.g_stat('mean',g,cnd,'ystim')
+            lod_plot(stim_ax,y_stim,color=black,xlim=x_lim)
 
             stim_ax.set_xlim(x_lim) 
             stim_ax.set_ylim([0, 10]) 
@@ -1460,10 +3181,219 @@ def plot_pop_flight_behavior_means_overlay(population_df, two_genotypes, wba_lim
     fig.text(.2,.95,two_genotypes[1],color='blue',fontsize=18)
     plt.draw()
     
-    saveas_path = '/Users/jamie/bin/figures/'
+    saveas_path = figure_dir(out_dir)
     plt.savefig(saveas_path + title_txt + '_population_kir_looming_means_overlay_' 
         + two_genotypes[0] + '_' + two_genotypes[1] + '.png',dpi=100)
     #plt.close('all')
 
+#---------------------------------------------------------------------------#
+# online mode -- trials are processed while the recording is still running
 
+class Ring_Buffer():
+    #fixed-size buffer of the most recent samples of several channels. samples
+    #are addressed by their absolute index in the stream
     
+    def __init__(self, channel_names, capacity):
+        self.channel_names = list(channel_names)
+        self.capacity = int(capacity)
+        self.data = np.zeros((len(self.channel_names),self.capacity))
+        self.n_written = 0
+        
+    def append(self, block):
+        #block = {channel name: 1d array}, all of the same length
+        n_new = np.size(block[self.channel_names[0]])
+        keep = min(n_new,self.capacity) #an oversized block only keeps its end
+        positions = (self.n_written + np.arange(n_new - keep,n_new)) % self.capacity
+        for ch_i, name in enumerate(self.channel_names):
+            self.data[ch_i,positions] = np.asarray(block[name])[n_new - keep:]
+        self.n_written = self.n_written + n_new
+        
+    def first_available(self):
+        return max(self.n_written - self.capacity,0)
+        
+    def get(self, name, start, stop):
+        #samples [start, stop) of one channel. nan where they are not buffered 
+        #(yet, or any more)
+        samples = np.empty(stop - start)
+        samples.fill(np.nan)
+        lo = max(start,self.first_available())
+        hi = min(stop,self.n_written)
+        if hi > lo:
+            samples[lo-start:hi-start] = self.data[self.channel_names.index(name),
+                                                   np.arange(lo,hi) % self.capacity]
+        return samples
+
+def replay_abf(abf_filename, block_dur=.1, fs=10000, real_time=True):
+    #stand-in for the amplifier -- yields blocks of the raw abf channels, paced 
+    #at fs when real_time is set
+    abf = read_abf_cached(abf_filename)
+    n_samples = np.size(abf['x_ch'])
+    block_size = int(block_dur*fs)
+    
+    t0 = time.time()
+    for start in range(0,n_samples,block_size):
+        stop = min(start + block_size,n_samples)
+        if real_time:
+            time.sleep(max(stop/float(fs) - (time.time() - t0),0))
+        yield dict([(ch,np.asarray(abf[ch][start:stop])) for ch in Online_Looming.raw_channels])
+
+class Online_Looming():
+    #incremental version of Looming_Phys.process_fly for a live rig. raw blocks
+    #go into a ring buffer; trial starts and stops are found in patid as it 
+    #arrives, with the parse_trial_times thresholds. a trial is summarized as 
+    #soon as post_trial samples after its stop are in, so the latency is bounded 
+    #by post_trial, the 1000 sample edge check and one block
+    
+    raw_channels = ['x_ch','y_ch','wba_l','wba_r','patid','vm','tach']
+    edge_gap = 1000 #edges closer than this are redundant, as in parse_trial_times
+    wing_lag = 12 #process_wings looks 12 samples ahead
+    
+    def __init__(self, buffer_dur=60, fs=10000, iti=750, pre_trial=25000, post_trial=10000,
+                 flight_thres=.90, flight_step_size=350, protocol='looming', stim_ao_codes=None,
+                 reference_fname=None):
+        #stim_ao_codes are the sorted ao codes of the stim types, by default those
+        #of the protocol's table (see stim_ao_code_tables), or else those of an 
+        #offline parse of reference_fname, an earlier recording of the protocol.
+        #without them, trials keep their ao code and get stim type -1 -- ranking 
+        #the codes seen so far would shift the types as conditions come in
+        self.buffer = Ring_Buffer(self.raw_channels,buffer_dur*fs)
+        self.fs = fs
+        self.iti = iti
+        self.pre_trial = pre_trial
+        self.post_trial = post_trial
+        self.flight_thres = flight_thres
+        self.flight_step_size = flight_step_size
+        self.protocol = protocol
+        if stim_ao_codes is None:
+            stim_ao_codes = stim_ao_code_tables.get(protocol)
+        if stim_ao_codes is None and reference_fname is not None:
+            reference = Looming_Phys(reference_fname,protocol)
+            reference.process_fly()
+            stim_ao_codes = fly_stim_ao_codes(reference)
+        if stim_ao_codes is None:
+            warnings.warn('no ao codes for protocol ' + repr(protocol) + ' -- stim types are -1,' + 
+                          ' pass stim_ao_codes or reference_fname')
+        self.stim_ao_codes = stim_ao_codes
+        
+        self.n_scanned = 0 #ao samples checked for edges
+        self.last_start = None #latest start/stop candidate, not yet known to be clean
+        self.last_stop = None
+        self.pending_start = None
+        self.queued_trs = [] #(start, stop) waiting for post trial samples
+        self.trials = []
+        
+    def process_block(self, block):
+        #add one block of raw samples. returns the summaries of the trials 
+        #that became complete
+        self.buffer.append(block)
+        self.find_trial_edges()
+        
+        new_trials = []
+        n_ready = self.buffer.n_written - self.wing_lag
+        while self.queued_trs and self.queued_trs[0][1] + max(self.post_trial,self.iti) <= n_ready:
+            start, stop = self.queued_trs.pop(0)
+            trial = self.summarize_trial(start,stop)
+            self.trials.append(trial)
+            new_trials.append(trial)
+        return new_trials
+        
+    def find_trial_edges(self):
+        #candidate edges as in ao_trial_edges. a candidate is kept once edge_gap
+        #samples pass without another one (parse_trial_times keeps the last 
+        #of a burst), and stops also need a positive ao just before them
+        n_written = self.buffer.n_written
+        scan_start = max(self.n_scanned - 1,self.buffer.first_available())
+        ao = self.buffer.get('patid',scan_start,n_written)
+        ao_diff = np.diff(ao)
+        
+        for cand in np.where(ao_diff > 5)[0] + scan_start:
+            if self.last_start is not None and cand - self.last_start >= self.edge_gap:
+                self.add_start(self.last_start + 1)
+            self.last_start = cand
+        for cand in np.where(ao_diff <= -4)[0] + scan_start:
+            if self.last_stop is not None and cand - self.last_stop >= self.edge_gap:
+                self.add_stop(self.last_stop + 1)
+            self.last_stop = cand
+        self.n_scanned = n_written
+        
+        #no later edge can make these redundant now
+        if self.last_start is not None and n_written - 1 - self.last_start >= self.edge_gap:
+            self.add_start(self.last_start + 1)
+            self.last_start = None
+        if self.last_stop is not None and n_written - 1 - self.last_stop >= self.edge_gap:
+            self.add_stop(self.last_stop + 1)
+            self.last_stop = None
+            
+    def add_start(self, start):
+        self.pending_start = start
+        
+    def add_stop(self, stop):
+        #stops before the first start, or without a positive ao, are dropped
+        if self.buffer.get('patid',stop-5,stop-4)[0] > 0 and \
+           self.pending_start is not None and stop > self.pending_start:
+            self.queued_trs.append((self.pending_start,stop))
+            self.pending_start = None
+            
+    def stim_type(self, ao_code):
+        if self.stim_ao_codes is None:
+            return -1
+        return int(table_stim_types([ao_code],self.stim_ao_codes)[0])
+        
+    def summarize_trial(self, start, stop):
+        #flight check, stim type, lmr and vm summaries and saccades of one trial.
+        #saccade starts are in samples from start - pre_trial, as in get_traces_by_stim
+        step = self.flight_step_size
+        flight_start = (start - self.iti)//step*step #flight windows stay aligned to the recording
+        flight_stop = -(-(stop + self.iti)//step)*step
+        win_start = min(start - self.pre_trial,flight_start)
+        win_stop = max(stop + self.post_trial,flight_stop)
+        
+        get = lambda ch, lag=0: self.buffer.get(ch,win_start + lag,win_stop + lag)
+        lmr = (-45 + get('wba_l',self.wing_lag)*33.75) - (-45 + get('wba_r',self.wing_lag)*33.75)
+        gap_starts, gap_stops = artifact_gaps(lmr_artifacts(lmr),np.size(lmr))
+        fill_gaps(lmr,gap_starts,gap_stops)
+        vm = get('vm') - 13 #offset for bridge potential
+        
+        flight_tests = flight_window_tests(get('tach')[flight_start-win_start:flight_stop-win_start],
+                                           lmr[flight_start-win_start:flight_stop-win_start],step)
+        flight_frac = np.mean(flight_tests) if np.size(flight_tests) else 0
+        ao_code = round(np.mean(self.buffer.get('patid',start,stop)),1)
+        
+        trial = {'tr':len(self.trials),'start':start,'stop':stop,'ao_code':ao_code,
+                 'stim_type':self.stim_type(ao_code),'flight_frac':flight_frac,
+                 'is_flying':flight_frac > self.flight_thres,
+                 'latency':(self.buffer.n_written - stop)/float(self.fs)} #s after the trial stop
+        if not trial['is_flying']: #gated, like remove_non_flight_trs
+            return trial
+        
+        tr_lmr = lmr[start-self.pre_trial-win_start:stop+self.post_trial-win_start]
+        tr_vm = vm[start-self.pre_trial-win_start:stop+self.post_trial-win_start]
+        with np.errstate(invalid='ignore'):
+            trial['lmr_baseline'] = np.nanmean(tr_lmr[:self.pre_trial])
+            trial['lmr_mean'] = np.nanmean(tr_lmr[self.pre_trial:self.pre_trial+stop-start])
+            trial['vm_baseline'] = np.nanmean(tr_vm[:self.pre_trial])
+            trial['vm_mean'] = np.nanmean(tr_vm[self.pre_trial:self.pre_trial+stop-start])
+        trial['lmr_turn_abs_max'] = turn_magnitudes(tr_lmr[:,np.newaxis],np.arange(self.pre_trial),
+                                                    np.arange(self.pre_trial,np.size(tr_lmr)))[0]
+        trial['saccade_starts'] = find_saccades_batch(tr_lmr,fs=self.fs)['start']
+        return trial
+        
+    def trial_table(self):
+        columns = ['tr','start','stop','ao_code','stim_type','flight_frac','is_flying','latency',
+                   'lmr_baseline','lmr_mean','vm_baseline','vm_mean','lmr_turn_abs_max','saccade_starts']
+        return pd.DataFrame(self.trials,columns=columns)
+        
+def run_online(stream, online=None, if_print=True):
+    #feed a stream of raw blocks (e.g. replay_abf) through an Online_Looming
+    if online is None:
+        online = Online_Looming()
+    for block in stream:
+        for trial in online.process_block(block):
+            if if_print:
+                txt = 'tr ' + str(trial['tr']) + ' : stim ' + str(trial['stim_type']) + \
+                      ', flight ' + str(round(trial['flight_frac'],2))
+                if trial['is_flying']:
+                    txt = txt + ', vm ' + str(round(trial['vm_mean'] - trial['vm_baseline'],1)) + \
+                          ' mV, ' + str(np.size(trial['saccade_starts'])) + ' saccades'
+                print txt + ' (' + str(round(trial['latency'],2)) + ' s)'
+    return online
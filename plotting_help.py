@@ -1,3 +1,5 @@
+import numpy as np
+
 orange = (0.85, 0.54, 0.24)
 purple = (0.5, 0.5, 1)
 blue = (0, 0, 1)
@@ -51,4 +53,64 @@ def set_legend(ax, facecolor='none', edgecolor='black', textcolor='black', loc='
     frame.set_facecolor(facecolor)
     frame.set_edgecolor(edgecolor)
     for text in legend.get_texts():
-        text.set_color(textcolor)
\ No newline at end of file
+        text.set_color(textcolor)
+
+
+lod_full_res = False #level of detail plotting off -- plot every sample
+
+def set_lod_full_res(full_res=True):
+    #force lod_plot to draw every sample, e.g. for final figures
+    global lod_full_res
+    lod_full_res = full_res
+
+def minmax_decimate(x, y, n_bins):
+    #min/max envelope of y in n_bins equal bins. the min and max of each bin 
+    #are kept in time order, so narrow peaks (saccades) survive decimation
+    n_samples = np.size(y)
+    bin_size = int(np.ceil(n_samples/float(n_bins)))
+    n_bins = int(np.ceil(n_samples/float(bin_size)))
+    
+    padded = np.empty(n_bins*bin_size)
+    padded.fill(np.nan)
+    padded[:n_samples] = y
+    padded = padded.reshape(n_bins,bin_size)
+    
+    is_nan = np.isnan(padded)
+    min_is = np.argmin(np.where(is_nan,np.inf,padded),axis=1)
+    max_is = np.argmax(np.where(is_nan,-np.inf,padded),axis=1)
+    
+    bin_starts = np.arange(n_bins)*bin_size
+    keep_is = np.vstack((bin_starts + np.minimum(min_is,max_is),
+                         bin_starts + np.maximum(min_is,max_is))).T.ravel()
+    keep_is = np.minimum(keep_is,n_samples-1)
+    
+    #all-nan bins keep a nan, which leaves a gap in the line as before
+    return np.asarray(x)[keep_is], np.asarray(y)[keep_is]
+    
+def lod_plot(ax, x, y=None, *args, **kwargs):
+    #ax.plot for long traces. the trace is decimated to a min/max envelope of
+    #about 2 points per pixel of the axes width. xlim = the x range that will
+    #be shown, if the axes are zoomed in after plotting. full_res=True (or
+    #set_lod_full_res) plots every sample
+    full_res = kwargs.pop('full_res',lod_full_res)
+    xlim = kwargs.pop('xlim',None)
+    
+    if y is None or isinstance(y,str):
+        if y is not None:
+            args = (y,) + args
+        y = x
+        x = y.index.values if hasattr(y,'index') else np.arange(np.size(y))
+    x = np.asarray(x)
+    y = np.asarray(y)
+    
+    n_bins = int(ax.get_window_extent().width)
+    if xlim is not None and np.size(x) > 1:
+        #keep 2 points per pixel within the zoomed range
+        x_span = float(np.nanmax(x) - np.nanmin(x))
+        n_bins = int(n_bins*max(x_span/(xlim[1] - xlim[0]),1))
+    
+    if full_res or n_bins < 1 or np.size(y) <= 2*n_bins:
+        return ax.plot(x,y,*args,**kwargs)
+    x_lod, y_lod = minmax_decimate(x,y,n_bins)
+    return ax.plot(x_lod,y_lod,*args,**kwargs)
+